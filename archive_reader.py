@@ -0,0 +1,31 @@
+import tarfile
+import zipfile
+import zlib
+
+# Emails inside zip and tar archives, read straight out of the archive without extracting them to disk
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+EMAIL_EXTENSIONS = (".msg", ".eml")
+
+# Errors from a damaged or truncated archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError, OSError)
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_archive(path):
+    # Yield (member name, bytes) for each email in the archive, in archive order
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(EMAIL_EXTENSIONS):
+                    yield info.filename, archive.read(info)
+        return
+
+    # "r|*" reads the tar as a stream, so a compressed tar is decompressed in one pass without seeking back
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith(EMAIL_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read()
@@ -0,0 +1,443 @@
+import contextlib
+import html
+import io
+import json
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import logging
+import tempfile
+
+import corpus
+import outlook
+from datetime import datetime
+
+from msg_reader import open_msg, Message
+from medialist import MediaIndex, NameMatcher, TierCache
+from setup_db import setup
+from sinks import SQLiteSink
+from records import Article
+
+# Benchmarks for the parser -- run with: python bench.py [names] [--out results.json]
+# Each benchmark prints its results and returns them as a dict, for comparing runs over time
+
+# Next to this file, so the benchmarks can be run from any folder
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Demo", "sample_email.msg")
+PATTERN = r"li class=(MsoListParagraph|\"MsoListParagraph\")([\s\S]*?)</li>"
+
+
+def legacy_get_title_pub(header):
+    # get_title_pub before the single-pass extractor, kept for comparison
+    header = str(header)
+    regex = re.search(r"[^<>]+(?=\(|sans-serif'>([\s\S]*?)</span>)", header)
+    title_pub = html.unescape(regex.group())
+    _list = title_pub.split('–')
+    if len(_list) < 2:
+        _list = title_pub.split('-')
+
+    platform = []
+    regex = re.findall(r"[^\">]+(?=</a)", header)
+    if len(regex) > 0:
+        for match in regex:
+            match = html.unescape(match)
+            platform.append(match)
+
+    pub_typelist = ["Online", "Facebook", "Instagram", "Twitter", "LinkedIn", "Linkedin", "Youtube"]
+    if len(platform) == 0:
+        for pub in pub_typelist:
+            if pub in header:
+                platform.append(pub)
+
+    print_check = re.findall(r"\bPrint\b", header)
+    if print_check != None:
+        for i in print_check:
+            print_type = i
+            platform.append(print_type)
+
+    links = re.findall(r"<a href=\"([\s\S]*?)\">", header)
+
+    try:
+        if len(_list) > 2:
+            title = _list[1].strip()
+            publication = _list[2].strip()
+        else:
+            title = _list[0].strip()
+            publication = _list[1].strip()
+    except IndexError:
+        title = _list[0].strip()
+
+    try:
+        return title, publication, platform, links
+    except UnboundLocalError:
+        publication = "N/A"
+        return title, publication, platform, links
+
+
+# List items the old extractor got wrong, with what they should come out as: no platform bracket, and the bracket
+# in a span of its own (the old extractor and the first tokenizer both read the <li> tag's attributes as the title)
+SPAN = "<b><span lang=EN-US style='font-size:10.0pt;font-family:\"Arial\",sans-serif'>"
+FIXED_HEADERS = [
+    (f" style='margin-left:0cm;mso-list:l0 level1 lfo1'>{SPAN}Budget 2021 &#8211; The Business Times</span></b>",
+     ("Budget 2021", "The Business Times", [], [])),
+    (f" style='margin-left:0cm;mso-list:l0 level1 lfo1'>{SPAN}Budget 2021 &#8211; The Business Times </span>"
+     f"<span lang=EN-US>(<a href=\"https://www.businesstimes.com.sg/budget\">Online</a>)</span></b>",
+     ("Budget 2021", "The Business Times", ["Online"], ["https://www.businesstimes.com.sg/budget"])),
+]
+
+
+def get_headers():
+    # List items from the sample email, plus variants for print, unlinked and extra-dash coverage
+    msg = open_msg(SAMPLE)
+    headers = re.findall(PATTERN, msg.HTMLBody)
+    headers += [
+        ("MsoListParagraph", f" style='margin-left:0cm'>{SPAN}Budget 2021 &#8211; The Business Times (Print)</span></b>"),
+        ("MsoListParagraph", f" style='margin-left:0cm'>{SPAN}Interview - Dell CEO - CNET (Online)</span></b>"),
+        ("MsoListParagraph", f" style='margin-left:0cm'>{SPAN}Gadgets of the year (2020) &#8211; Tech4tea "
+                             f"(<a href=\"https://tech4tea.com/gadgets\">Online</a> &amp; Print)</span></b>"),
+    ]
+    return headers
+
+
+def bench_title_pub(repeat=2000):
+    logging.disable(logging.CRITICAL)
+    headers = get_headers()
+
+    # Check both extractors agree on the fixtures
+    # (the old extractor ran on str() of a tuple, so line breaks came through as literal "\r\n")
+    for header in headers:
+        title, publication, platform, links = legacy_get_title_pub(header)
+        old = title, publication, [p.replace("\\r\\n", "").strip() for p in platform], links
+        new = outlook.get_title_pub(header[1])
+        if old != new:
+            print(f"Mismatch:\n  before = {old}\n  after  = {new}")
+    for header, expected in FIXED_HEADERS:
+        new = outlook.get_title_pub(header)
+        if new != expected:
+            print(f"Mismatch:\n  expected = {expected}\n  after    = {new}")
+
+    results = {}
+    for name, func, args in [("before", legacy_get_title_pub, headers),
+                             ("after", outlook.get_title_pub, [h[1] for h in headers])]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for header in args:
+                func(header)
+        elapsed = time.perf_counter() - start
+        results[f"{name}_headers_per_s"] = len(args) * repeat / elapsed
+        print(f"get_title_pub {name}: {len(args) * repeat / elapsed:,.0f} headers/s")
+
+    # Synthetic list items, with every quote and dash variant
+    items = re.findall(PATTERN, corpus.build_html(corpus.make_articles(2000, corpus.make_medialist(100))))
+    start = time.perf_counter()
+    for _, header in items:
+        outlook.get_title_pub(header)
+    elapsed = time.perf_counter() - start
+    results["synthetic_headers_per_s"] = len(items) / elapsed
+    print(f"get_title_pub synthetic: {len(items) / elapsed:,.0f} headers/s ({len(items)} items)")
+    return results
+
+
+def legacy_list_items(msg):
+    # Body search before find_list_items: decode the whole body, copy out <body>, then findall
+    body = re.search(r"<body([\s\S]*)</body>", msg.HTMLBody).group()
+    return [header for _, header in re.findall(PATTERN, body)]
+
+
+def bench_body(size=4_000_000, emails=5):
+    # Emails with multi-MB bodies -- mostly filler paragraphs around 50 list items
+    with tempfile.TemporaryDirectory() as folder:
+        paths = corpus.make_corpus(folder, emails, articles=50, attachments=0, padding=size // 2)
+
+        # Check both versions agree
+        for path in paths:
+            if legacy_list_items(open_msg(path)) != outlook.find_list_items(open_msg(path).raw_body):
+                print(f"Mismatch in {path}")
+
+        results = {"body_bytes": os.path.getsize(paths[0])}
+        for name, func in [("before", legacy_list_items),
+                           ("after", lambda msg: outlook.find_list_items(msg.raw_body, msg.codepage))]:
+            start = time.perf_counter()
+            for path in paths:
+                func(open_msg(path))
+            elapsed = time.perf_counter() - start
+            results[f"{name}_emails_per_s"] = emails / elapsed
+            print(f"List items {name}: {emails / elapsed:,.1f} emails/s ({results['body_bytes'] / 1e6:.1f} MB each)")
+    return results
+
+
+def legacy_get_date(msg, publication, pubsplit):
+    # get_date before the attachment index, kept for comparison (without the debug logging)
+    count_attachments = msg.Attachments.Count
+    year = str(msg.SentOn)[0:4]
+    if count_attachments > 0:
+        for item in range(count_attachments):
+            filename = msg.Attachments.Item(item + 1).Filename
+            if (re.search(f"^.*{publication}.*$", filename, flags=re.I) != None):
+                return f"{filename.split('-')[0]}{year}"
+
+        for item in range(count_attachments):
+            filename = msg.Attachments.Item(item + 1).Filename
+            for i in range(len(pubsplit) - 1):
+                if (re.search(f"^.*{pubsplit[i]}.*$", filename, flags=re.I) != None):
+                    if (re.search(f"^.*{pubsplit[i+1]}.*$", filename, flags=re.I) != None):
+                        return f"{filename.split('-')[0]}{year}"
+                else:
+                    new_string = re.compile('[^a-zA-Z]').sub("", pubsplit[i])
+                    if (re.search(f"^.*{new_string}.*$", filename, flags=re.I) != None):
+                        return f"{filename.split('-')[0]}{year}"
+
+        return str(msg.SentOn)[0:9]
+
+
+def get_attachment_fixture(count=40):
+    # One email with a PDF clipping per article; a third of the articles only match on their first words
+    filenames = [f"{day % 28 + 1} June - Outlet{day} Daily News.pdf" for day in range(count)]
+    publications = []
+    for day in range(count):
+        if day % 3 == 0:
+            publications.append(f"Outlet{day} Daily Online")
+        elif day % 3 == 1:
+            publications.append(f"The Outlet{day}")
+        else:
+            publications.append(f"Outlet{day} Daily News")
+    msg = Message("", datetime(2020, 6, 30), filenames)
+    return msg, publications
+
+
+def bench_date(repeat=20):
+    logging.disable(logging.CRITICAL)
+    msg, publications = get_attachment_fixture()
+
+    # Check both versions agree on the fixture -- where no attachment matches, the old version returned the first
+    # 9 characters of the send date, which parse_email could never read, and the new one returns None
+    attachments = outlook.AttachmentIndex(msg)
+    for publication in publications:
+        old = legacy_get_date(msg, publication, publication.split())
+        if old == str(msg.SentOn)[0:9]:
+            old = None
+        new = outlook.get_date(attachments, publication, publication.split())
+        if old != new:
+            print(f"Mismatch for {publication}: before = {old}, after = {new}")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for publication in publications:
+            legacy_get_date(msg, publication, publication.split())
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        attachments = outlook.AttachmentIndex(msg)
+        for publication in publications:
+            outlook.get_date(attachments, publication, publication.split())
+    after = time.perf_counter() - start
+
+    articles = len(publications) * repeat
+    print(f"get_date before: {articles / before:,.0f} articles/s ({msg.Attachments.Count} attachments)")
+    print(f"get_date after: {articles / after:,.0f} articles/s ({msg.Attachments.Count} attachments)")
+    return {"before_articles_per_s": articles / before, "after_articles_per_s": articles / after,
+            "attachments": msg.Attachments.Count}
+
+
+def bench_tiercat(outlets=20000, articles=20000, popular=500):
+    # Articles mention a few hundred popular outlets (plus unknown ones), resolved against a large media list:
+    # without the cache, then with a cold and a warm cache
+    logging.disable(logging.CRITICAL)
+    rows = corpus.make_medialist(outlets)
+
+    start = time.perf_counter()
+    outlook.media_index = MediaIndex(rows)
+    outlook.name_matcher = NameMatcher(rows)
+    build = time.perf_counter() - start
+
+    fixtures = corpus.make_articles(articles, rows[:popular])
+    results = {"outlets": outlets, "index_build_s": build}
+    print(f"get_tiercat: {outlets:,} outlets, indexes built in {build:.2f}s")
+
+    with tempfile.TemporaryDirectory() as folder:
+        medialist_path = os.path.join(folder, "medialist.csv")
+        corpus.write_medialist(medialist_path, rows)
+        with contextlib.redirect_stdout(io.StringIO()):
+            db = setup(db_path=os.path.join(folder, "bench.db"), medialist_path=medialist_path)
+
+        for name in ["no_cache", "cold_cache", "warm_cache"]:
+            if name == "no_cache":
+                outlook.tiercat_cache = None
+            elif name == "cold_cache":
+                outlook.tiercat_cache = TierCache(db, rows)
+            else:
+                # Same as the next run: results are in the table, but not in memory
+                outlook.tiercat_cache.flush()
+                outlook.tiercat_cache = TierCache(db, rows)
+
+            start = time.perf_counter()
+            for _, publication, _, links in fixtures:
+                outlook.get_tiercat(links, publication, publication.split())
+            elapsed = time.perf_counter() - start
+
+            results[f"{name}_articles_per_s"] = articles / elapsed
+            cache = outlook.tiercat_cache
+            hit_rate = f", {cache.hits / (cache.hits + cache.misses):.0%} hit rate" if cache else ""
+            print(f"  {name.replace('_', ' ')}: {articles / elapsed:,.0f} articles/s{hit_rate}")
+
+        outlook.tiercat_cache = None
+        db.close()
+    return results
+
+
+def make_database(folder, outlets, articles, batch_size=100):
+    # Fill a new database in folder with synthetic articles, returning (path, seconds spent inserting)
+    rows = corpus.make_medialist(outlets)
+    db_path = os.path.join(folder, "bench.db")
+    medialist_path = os.path.join(folder, "medialist.csv")
+    corpus.write_medialist(medialist_path, rows)
+
+    # setup() prints a summary of the medialist it loads, and the first outlets added
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = setup(db_path=db_path, medialist_path=medialist_path)
+
+    # Titles are unique in the articles table, so number them
+    rng = random.Random(0)
+    records = [Article(f"{rng.randint(1, 28)} June 2021", f"{title} {i}", publication, rng.randint(1, 3),
+                       rng.choice(corpus.CATEGORIES), platforms, links, f"email{i // 20}.msg")
+               for i, (title, publication, platforms, links) in enumerate(corpus.make_articles(articles, rows, 3))]
+
+    sink = SQLiteSink(db)
+    start = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+        sink.write([(records[i].file, records[i:i + batch_size])])
+        db.commit()
+    sink.close()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return db_path, elapsed
+
+
+def bench_insert(articles=20000):
+    with tempfile.TemporaryDirectory() as folder:
+        _, elapsed = make_database(folder, 1000, articles)
+    print(f"Database insert: {articles / elapsed:,.0f} articles/s ({articles:,} articles, 3 links each)")
+    return {"articles_per_s": articles / elapsed, "articles": articles}
+
+
+def bench_export(articles=20000):
+    import excel
+    with tempfile.TemporaryDirectory() as folder:
+        db_path, _ = make_database(folder, 1000, articles)
+        start = time.perf_counter()
+        excel.export(db_path, os.path.join(folder, "out.xlsx"))
+        elapsed = time.perf_counter() - start
+    print(f"Excel export: {articles / elapsed:,.0f} articles/s ({articles:,} articles)")
+    return {"articles_per_s": articles / elapsed, "articles": articles}
+
+
+def bench_end_to_end(emails=200, workers=1):
+    # Whole pipeline from .msg files to the database, with 20 articles and 5 attachments per email
+    # main() sets up logging to the console, so give the root logger a handler first to keep it quiet
+    logging.disable(logging.CRITICAL)
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as folder:
+        rows = corpus.make_medialist(2000)
+        medialist_path = os.path.join(folder, "medialist.csv")
+        corpus.write_medialist(medialist_path, rows)
+        corpus.make_corpus(os.path.join(folder, "emails"), emails, medialist=rows)
+
+        # Run from the temporary folder, as main() opens log.txt in the working directory
+        cwd = os.getcwd()
+        os.chdir(folder)
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                outlook.main([os.path.join(folder, "emails")], os.path.join(folder, "bench.db"), medialist_path,
+                             workers=workers)
+        finally:
+            os.chdir(cwd)
+        elapsed = time.perf_counter() - start
+
+    print(f"End to end: {emails / elapsed:,.1f} emails/s ({emails} emails, {workers} worker(s))")
+    return {"emails_per_s": emails / elapsed, "emails": emails, "workers": workers}
+
+
+def bench_mbox(emails=200, padding=250_000):
+    # Whole pipeline on one mbox of padded emails, reported in MB/s of mbox read
+    logging.disable(logging.CRITICAL)
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    with tempfile.TemporaryDirectory() as folder:
+        rows = corpus.make_medialist(2000)
+        medialist_path = os.path.join(folder, "medialist.csv")
+        corpus.write_medialist(medialist_path, rows)
+        mbox_path = os.path.join(folder, "coverage.mbox")
+        corpus.make_corpus(mbox_path, emails, medialist=rows, padding=padding, format="mbox")
+        size = os.path.getsize(mbox_path) / 1e6
+
+        cwd = os.getcwd()
+        os.chdir(folder)
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                outlook.main([mbox_path], os.path.join(folder, "bench.db"), medialist_path)
+        finally:
+            os.chdir(cwd)
+        elapsed = time.perf_counter() - start
+
+    print(f"mbox: {size / elapsed:,.1f} MB/s, {emails / elapsed:,.1f} emails/s ({size:,.0f} MB, {emails} emails)")
+    return {"mb_per_s": size / elapsed, "emails_per_s": emails / elapsed, "mb": size, "emails": emails}
+
+
+def bench_partitions(articles=60000, key="category"):
+    # One workbook per category, one after another vs. in parallel worker processes
+    import excel
+    with tempfile.TemporaryDirectory() as folder:
+        db_path, _ = make_database(folder, 1000, articles)
+        values = [row[0] for row in excel.connect_readonly(db_path).execute(
+            f"SELECT DISTINCT {excel.PARTITION_KEYS[key]} FROM articles a")]
+
+        start = time.perf_counter()
+        for value in values:
+            excel.export(db_path, os.path.join(folder, f"serial_{value}.xlsx"), key=key, value=value)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            excel.export_partitions(db_path, key, os.path.join(folder, "reports"))
+        parallel = time.perf_counter() - start
+
+    print(f"Partitioned export ({len(values)} workbooks by {key}, {articles:,} articles): "
+          f"one by one {serial:.2f}s, parallel {parallel:.2f}s ({serial / parallel:.1f}x, {os.cpu_count()} CPUs)")
+    return {"serial_s": serial, "parallel_s": parallel, "workbooks": len(values), "articles": articles}
+
+
+BENCHMARKS = {
+    "title_pub": bench_title_pub,
+    "body": bench_body,
+    "date": bench_date,
+    "tiercat": bench_tiercat,
+    "insert": bench_insert,
+    "export": bench_export,
+    "partitions": bench_partitions,
+    "end_to_end": bench_end_to_end,
+    "mbox": bench_mbox,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the email parser on the sample email and synthetic data")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--out", help="also write results to this JSON file")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    results = {"python": sys.version.split()[0], "time": datetime.now().isoformat(timespec="seconds")}
+    for name in args.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
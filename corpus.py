@@ -0,0 +1,260 @@
+import csv
+import html
+import os
+import random
+import struct
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+# Synthetic coverage emails and media lists for benchmarks -- see bench.py
+
+PLATFORMS = ["Online", "Facebook", "Instagram", "Twitter", "LinkedIn", "Youtube"]
+CATEGORIES = ["Business", "National", "Channel", "Trade", "Vertical", "Lifestyle"]
+SUFFIXES = [".com", ".com.sg", ".co.uk", ".net", ".asia"]
+WORDS = ["apple", "dell", "launches", "new", "gaming", "laptop", "keyboard", "display", "research", "market",
+         "growth", "cloud", "security", "data", "centre", "singapore", "asia", "report", "quarter", "record",
+         "chip", "design", "remote", "work", "hybrid", "sales", "partner", "startup", "funding", "ai"]
+
+# Dash variants seen between title and publication: en dash (escaped or not) and short dash
+DASHES = ["&#8211;", "–", "-"]
+
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+          "November", "December"]
+
+
+def make_medialist(count, rng=None):
+    # (url, tier, type) rows -- one outlet per row, some with a path e.g. outlet12.com/asia
+    rng = rng or random.Random(0)
+    rows = []
+    for i in range(count):
+        url = f"outlet{i}{rng.choice(SUFFIXES)}"
+        if rng.random() < 0.1:
+            url += "/asia"
+        rows.append((url, rng.randint(1, 3), rng.choice(CATEGORIES)))
+    return rows
+
+
+def write_medialist(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["url", "tier", "type"])
+        writer.writerows(rows)
+
+
+def make_articles(count, medialist, links=2, rng=None):
+    # Articles as (title, publication, platforms, links); roughly half point at outlets in the media list
+    rng = rng or random.Random(0)
+    articles = []
+    for _ in range(count):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 10))).capitalize()
+        if medialist and rng.random() < 0.5:
+            url, _, _ = rng.choice(medialist)
+            host = url.split("/")[0]
+            # Outlet name, maybe with a word after it, or the site's own name e.g. "Outlet12.com.sg"
+            publication = rng.choice([host.split(".")[0], host]).capitalize() + rng.choice(["", " Asia", " Online"])
+        else:
+            host = f"unknown{rng.randint(0, 1000)}.com"
+            publication = f"Unknown {rng.choice(WORDS).capitalize()}"
+
+        platforms = rng.sample(PLATFORMS, min(links, len(PLATFORMS)))
+        article_links = [f"https://www.{host}/{rng.choice(WORDS)}/{rng.randint(0, 10 ** 9)}"
+                         for _ in range(len(platforms))]
+        articles.append((title, publication, platforms, article_links))
+    return articles
+
+
+def build_html(articles, rng=None, padding=0):
+    # Coverage email body as Word would save it -- list items with <a> tags per platform
+    # padding adds that many bytes of unrelated markup, to get multi-MB bodies
+    rng = rng or random.Random(0)
+    items = []
+    for title, publication, platforms, links in articles:
+        anchors = ", ".join(f'<a href="{link}">{platform}</a>' for platform, link in zip(platforms, links))
+        quote = rng.choice(['"MsoListParagraph"', "MsoListParagraph"])
+        dash = rng.choice(DASHES)
+        items.append(f"<li class={quote} style='margin-left:0cm;mso-list:l0 level1 lfo1'><b>"
+                     f"<span lang=EN-US style='font-size:10.0pt;font-family:\"Arial\",sans-serif'>"
+                     f"{html.escape(title, quote=False)} {dash} {html.escape(publication, quote=False)} "
+                     f"({anchors})<o:p></o:p></span></b></li>\r\n")
+
+    filler = ""
+    if padding:
+        paragraph = "<p class=MsoNormal><span style='font-size:11.0pt'>" + " ".join(WORDS) + "</span></p>\r\n"
+        filler = paragraph * (padding // len(paragraph) + 1)
+
+    return ("<html><head><meta name=Generator content=\"Microsoft Word 15 (filtered medium)\"></head>"
+            f"<body lang=EN-SG link=\"#0563C1\">\r\n{filler}<ul style='margin-top:0cm' type=disc>\r\n"
+            f"{''.join(items)}</ul>\r\n{filler}</body></html>")
+
+
+def make_attachments(articles, sent_on, count, rng=None):
+    # PDF clippings named like "26 June - Publication.pdf" for the first count articles
+    rng = rng or random.Random(0)
+    names = []
+    for _, publication, _, _ in articles[:count]:
+        day = sent_on - timedelta(days=rng.randint(0, 5))
+        names.append(f"{day.day} {MONTHS[day.month - 1]} - {publication}.pdf")
+    return names
+
+
+def make_corpus(folder, emails=10, articles=20, links=2, attachments=5, medialist=None, padding=0, seed=0,
+                format="msg"):
+    # Write emails to folder as .msg or .eml files and return their paths
+    # With format="mbox", folder is the path of a single mbox file holding every email instead
+    rng = random.Random(seed)
+    if format == "mbox":
+        os.makedirs(os.path.dirname(folder) or ".", exist_ok=True)
+        mbox = open(folder, "wb")
+    else:
+        os.makedirs(folder, exist_ok=True)
+
+    paths = []
+    for i in range(emails):
+        email_articles = make_articles(articles, medialist, links, rng)
+        sent_on = datetime(2021, 1, 1, tzinfo=timezone.utc) + timedelta(days=i % 365, hours=rng.randint(0, 23))
+        body = build_html(email_articles, rng, padding)
+        names = make_attachments(email_articles, sent_on, attachments, rng)
+        if format == "mbox":
+            paths.append(f"{folder}#{mbox.tell()}")
+            mbox.write(b"From coverage@example.com " + sent_on.strftime("%a %b %d %H:%M:%S %Y").encode() + b"\n")
+            mbox.write(build_eml(body, sent_on, names).replace(b"\nFrom ", b"\n>From ") + b"\n")
+            continue
+
+        path = os.path.join(folder, f"coverage_{i:05d}.{format}")
+        if format == "eml":
+            with open(path, "wb") as f:
+                f.write(build_eml(body, sent_on, names))
+        else:
+            write_msg(path, body, sent_on, names)
+        paths.append(path)
+
+    if format == "mbox":
+        mbox.close()
+    return paths
+
+
+def build_eml(html_body, sent_on, attachment_names):
+    # MIME email with the HTML body and empty PDF attachments, as bytes with \n line endings
+    msg = EmailMessage()
+    msg["From"] = "coverage@example.com"
+    msg["Subject"] = "Coverage report"
+    msg["Date"] = format_datetime(sent_on)
+    msg.set_content(html_body, subtype="html")
+    for name in attachment_names:
+        msg.add_attachment(b"%PDF-1.4", maintype="application", subtype="pdf", filename=name)
+    return msg.as_bytes()
+
+
+# Minimal OLE compound file writer, enough for msg_reader ([MS-CFB] version 3, 512 byte sectors)
+SECTOR = 512
+MINI_SECTOR = 64
+MINI_CUTOFF = 4096
+END_OF_CHAIN = 0xFFFFFFFE
+FAT_SECT = 0xFFFFFFFD
+FREE_SECT = 0xFFFFFFFF
+NO_STREAM = 0xFFFFFFFF
+
+
+def write_msg(path, html_body, sent_on, attachment_names):
+    filetime = int((sent_on - datetime(1601, 1, 1, tzinfo=timezone.utc)).total_seconds() * 10 ** 7)
+
+    # Top-level properties: 32 byte header, then client submit time and internet code page (UTF-8)
+    header = struct.pack("<8xIIII8x", 0, len(attachment_names), 0, len(attachment_names))
+    props = header + struct.pack("<IIq", 0x00390040, 6, filetime) + struct.pack("<IIq", 0x3FDE0003, 6, 65001)
+
+    root = [("__substg1.0_10130102", html_body.encode("utf-8")),
+            ("__properties_version1.0", props)]
+    for i, name in enumerate(attachment_names):
+        root.append((f"__attach_version1.0_#{i:08X}", [
+            ("__substg1.0_3707001F", name.encode("utf-16-le")),
+            ("__properties_version1.0", b"\x00" * 8)]))
+
+    with open(path, "wb") as f:
+        f.write(build_compound_file(root))
+
+
+def build_compound_file(children):
+    # Flatten the tree into directory entries: [name, type, data, child ids]
+    entries = [["Root Entry", 5, b"", []]]
+
+    def add(parent, items):
+        for name, value in items:
+            entries.append([name, 1 if isinstance(value, list) else 2, b"" if isinstance(value, list) else value, []])
+            entries[parent][3].append(len(entries) - 1)
+            if isinstance(value, list):
+                add(len(entries) - 1, value)
+
+    add(0, children)
+
+    # Children are linked as a chain of right siblings, sorted the way [MS-CFB] compares names
+    right = {}
+    for entry in entries:
+        entry[3].sort(key=lambda i: (len(entries[i][0]), entries[i][0].upper()))
+        for current, following in zip(entry[3], entry[3][1:]):
+            right[current] = following
+
+    # Small streams go in the mini stream, large ones in their own sectors
+    mini_stream = bytearray()
+    mini_fat = []
+    big = []
+    starts = {}
+    for i, (_, entry_type, data, _) in enumerate(entries):
+        if entry_type != 2 or not data:
+            continue
+        if len(data) < MINI_CUTOFF:
+            sectors = -(-len(data) // MINI_SECTOR)
+            starts[i] = len(mini_fat)
+            mini_fat.extend(range(len(mini_fat) + 1, len(mini_fat) + sectors))
+            mini_fat.append(END_OF_CHAIN)
+            mini_stream += data.ljust(sectors * MINI_SECTOR, b"\x00")
+        else:
+            big.append(i)
+
+    # Lay out sectors: big streams, mini stream, mini FAT, directory, then the FAT itself
+    body = []
+    fat = []
+
+    def allocate(data):
+        count = -(-len(data) // SECTOR)
+        start = len(fat)
+        fat.extend(range(start + 1, start + count))
+        fat.append(END_OF_CHAIN)
+        body.append(bytes(data).ljust(count * SECTOR, b"\x00"))
+        return start
+
+    for i in big:
+        starts[i] = allocate(entries[i][2])
+    mini_start = allocate(mini_stream) if mini_stream else END_OF_CHAIN
+    mini_fat_data = struct.pack(f"<{len(mini_fat)}I", *mini_fat)
+    mini_fat_start = allocate(mini_fat_data) if mini_fat else END_OF_CHAIN
+    mini_fat_count = -(-len(mini_fat_data) // SECTOR)
+
+    directory = bytearray()
+    for i, (name, entry_type, data, child_ids) in enumerate(entries):
+        child = child_ids[0] if child_ids else NO_STREAM
+        start = mini_start if i == 0 else starts.get(i, END_OF_CHAIN)
+        size = len(mini_stream) if i == 0 else len(data)
+        encoded = (name + "\x00").encode("utf-16-le")
+        directory += struct.pack("<64sHBBIII16xIQQIQ", encoded, len(encoded), entry_type, 1, NO_STREAM,
+                                 right.get(i, NO_STREAM), child, 0, 0, 0, start, size)
+    directory_start = allocate(directory.ljust(-(-len(directory) // SECTOR) * SECTOR, b"\x00"))
+
+    # Each FAT sector holds 128 entries, including the entries for the FAT sectors themselves
+    fat_count = 1
+    while (len(fat) + fat_count) > fat_count * (SECTOR // 4):
+        fat_count += 1
+    if fat_count > 109:
+        raise ValueError("File too large for this writer")
+    fat_start = len(fat)
+    fat.extend([FAT_SECT] * fat_count)
+    fat.extend([FREE_SECT] * (fat_count * (SECTOR // 4) - len(fat)))
+    body.append(struct.pack(f"<{len(fat)}I", *fat))
+
+    difat = list(range(fat_start, fat_start + fat_count)) + [FREE_SECT] * (109 - fat_count)
+    header = (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1" + b"\x00" * 16 +
+              struct.pack("<HHHHH6xIIIIIIIII", 0x3E, 3, 0xFFFE, 9, 6, 0, fat_count, directory_start, 0,
+                          MINI_CUTOFF, mini_fat_start, mini_fat_count, END_OF_CHAIN, 0) +
+              struct.pack("<109I", *difat))
+    return header + b"".join(body)
+
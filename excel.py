@@ -1,11 +1,42 @@
 import sqlite3
-import xlsxwriter
-import win32com.client as win32
 
 import sys
 import os
+import re
+import time
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from pathlib import Path
+
+from archive_reader import ARCHIVE_EXTENSIONS
+from mail_reader import is_maildir
+from records import Article
+
+# Columns for the tier & category flags
+HEADER = ["Date", "Title", "Publication", "In Tier 1?", "In Tier 2?", "In Tier 3?",
+          "Business", "National", "Channel", "Trade", "Vertical", "Lifestyle"]
+TIER_COLUMNS = {1: 3, 2: 4, 3: 5}
+CATEGORY_COLUMNS = {"Business": 6, "National": 7, "Channel": 8, "Trade": 9, "Vertical": 10, "Lifestyle": 11}
+FIRST_FLAG_COLUMN = 3
+
+# One-hot flag rows from column D, by (tier, category) -- see flag_row()
+FLAG_ROWS = {}
+
+# Partition keys for export_partitions(), as SQL expressions over the articles table
+# Dates are stored as "dd/mm/yy", so the month is "20yy-mm"; the client is the folder or archive the email came from
+PARTITION_KEYS = {
+    "month": "CASE WHEN a.date LIKE '__/__/__' THEN '20' || substr(a.date, 7, 2) || '-' || substr(a.date, 4, 2) "
+             "ELSE 'unknown' END",
+    "tier": "COALESCE(CAST(a.tier AS TEXT), 'N/A')",
+    "category": "COALESCE(a.category, 'N/A')",
+    "client": "client_tag(a.file)",
+}
+
+def main(open_when_done=False):
+    import xlsxwriter
 
-def main():
     workbook = xlsxwriter.Workbook("out.xlsx")
     worksheet = workbook.add_worksheet()
 
@@ -27,6 +58,9 @@ def main():
               "Business", "National", "Channel", "Trade", "Vertical", "Lifestyle"]
     worksheet.write_row("A1", header, bold)
 
+    # Keep track of the widest value in each column, instead of autofitting in Excel afterwards
+    widths = ColumnWidths(header, set_flag_columns(worksheet, center_align))
+
     # Create variables to keep track of rows in excel and 'original' rows before extra rows are added
     row_counter = 0
     og_rows = []
@@ -44,6 +78,7 @@ def main():
         for item_num, item in enumerate(row):
             print(item_num, item)
             worksheet.write(row_counter + 1, item_num, item)
+            widths.update(item_num, item)
 
             # Special handling for title - hyperlinks
             if item_num == 1:
@@ -54,6 +89,7 @@ def main():
             if item_num == 2:
                 publication = item
                 worksheet.write(row_counter + 1, item_num, f"{publication} ({platform_list[0]})")
+                widths.update(item_num, f"{publication} ({platform_list[0]})")
 
                 for i in range(extra_rows):
                     # To write to current row below original row, add 1 to counter
@@ -62,6 +98,7 @@ def main():
                     # Iterate through items (e.g. date, title, publication) in row
                     for item_num, item in enumerate(row):
                         worksheet.write(row_counter + 1, item_num, item)
+                        widths.update(item_num, item)
 
                         # Special handling for title - secondary hyperlinks (i + 1 as [0] already covered )
                         if item_num == 1:
@@ -80,6 +117,7 @@ def main():
 
                             try:
                                 worksheet.write(row_counter + 1, item_num, f"{publication} ({platform_list[i + 1]})")
+                                widths.update(item_num, f"{publication} ({platform_list[i + 1]})")
                                 print(f"  Type{i} = {platform_list[i + 1]}")
 
                             # If out of range, don't include additional type
@@ -90,45 +128,190 @@ def main():
         # After iterating thorugh each original row, add 1 to row counter
         row_counter += 1
 
-    for i, row in enumerate(rows2):
-        tier = row[0]
-        category = row[1]
-
-        if tier == 1:
-            worksheet.write(f"D{2 + og_rows[i]}", 1, center_align)
-
-        if tier == 2:
-            worksheet.write(f"E{2 + og_rows[i]}", 1, center_align)
-
-        if tier == 3:
-            worksheet.write(f"F{2 + og_rows[i]}", 1, center_align)
-
-        if category == "Business":
-            worksheet.write(f"G{2 + og_rows[i]}", 1, center_align)
-
-        if category == "National":
-            worksheet.write(f"H{2 + og_rows[i]}", 1, center_align)
-
-        if category == "Channel":
-            worksheet.write(f"I{2 + og_rows[i]}", 1, center_align)
-
-        if category == "Trade":
-            worksheet.write(f"J{2 + og_rows[i]}", 1, center_align)
-
-        if category == "Vertical":
-            worksheet.write(f"K{2 + og_rows[i]}", 1, center_align)
-
-        if category == "Lifestyle":
-            worksheet.write(f"L{2 + og_rows[i]}", 1, center_align)
+    # Tier & category flags as one write per article, centred by the column format
+    for i, (tier, category) in enumerate(rows2):
+        worksheet.write_row(1 + og_rows[i], FIRST_FLAG_COLUMN, flag_row(tier, category))
 
     print(f"Last excel row = {row_counter}")
     worksheet.conditional_format(f"A1:C{row_counter}", {'type': 'blanks', 'format': highlight})
     worksheet.conditional_format(f"A1:C{row_counter}", {'type': 'text',
                                                         'criteria': 'containing', 'value': 'N/A', 'format': highlight})
 
+    widths.apply(worksheet)
     workbook.close()
-    autofit(path)
+
+    if open_when_done:
+        open_workbook(os.path.join(path, "out.xlsx"))
     
+def export(db_path="emails.db", out_path="out.xlsx", open_when_done=False, key=None, value=None):
+    # With a partition key (see PARTITION_KEYS), only the articles whose key is value are written
+    import xlsxwriter
+
+    # Stream articles joined with their links in one query, writing each Excel row once
+    # constant_memory flushes each row to disk as soon as the next one starts, so memory stays flat
+    workbook = xlsxwriter.Workbook(out_path, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    highlight, center_align, red_fill, bold = format(workbook)
+    worksheet.write_row(0, 0, HEADER, bold)
+    widths = ColumnWidths(HEADER, set_flag_columns(worksheet, center_align))
+
+    db = connect_readonly(db_path)
+    where = f"WHERE {PARTITION_KEYS[key]} = ?" if key else ""
+    rows = db.execute(f"""
+    SELECT a.id, a.date, a.title, a.publication, a.tier, a.category, l.platform, l.url
+    FROM articles a LEFT JOIN article_links l ON l.article_id = a.id
+    {where}
+    ORDER BY a.id, l.position
+    """, (value,) if key else ())
+
+    row_counter = 0
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        article = Article(*group[0][1:6], platforms=[row[6] for row in group if row[6] is not None],
+                          links=[row[7] for row in group if row[7] is not None])
+        date, title, publication = article.date, article.title, article.publication
+        platform_list, link_list = article.platforms, article.links
+
+        # One row per link or platform, whichever there are more of
+        for i in range(max(len(link_list), len(platform_list), 1)):
+            row_counter += 1
+            worksheet.write(row_counter, 0, date)
+            widths.update(0, date)
+
+            # Title hyperlinked to the i-th link -- left blank on extra rows without a link
+            if i < len(link_list):
+                worksheet.write_url(row_counter, 1, link_list[i], string=f"{title}")
+                widths.update(1, title)
+            elif i == 0:
+                worksheet.write(row_counter, 1, title)
+                widths.update(1, title)
+            else:
+                worksheet.write(row_counter, 1, "")
+
+            # Publication with the i-th platform, or the first platform if there are fewer platforms than links
+            if i < len(platform_list):
+                pub_platform = f"{publication} ({platform_list[i]})"
+            elif platform_list:
+                pub_platform = f"{publication} ({platform_list[0]})"
+            else:
+                pub_platform = publication
+            worksheet.write(row_counter, 2, pub_platform)
+            widths.update(2, pub_platform)
+
+            # Tier & category flags on the first row of each article only
+            if i == 0:
+                worksheet.write_row(row_counter, FIRST_FLAG_COLUMN, flag_row(article.tier, article.category))
+
+    db.close()
+
+    last_row = row_counter + 1
+    worksheet.conditional_format(f"A1:C{last_row}", {'type': 'blanks', 'format': highlight})
+    worksheet.conditional_format(f"A1:C{last_row}", {'type': 'text',
+                                                    'criteria': 'containing', 'value': 'N/A', 'format': highlight})
+
+    widths.apply(worksheet)
+    workbook.close()
+
+    if open_when_done:
+        open_workbook(os.path.abspath(out_path))
+
+    return row_counter
+
+
+def flag_row(tier, category):
+    # 1s in the tier and category columns and blanks in between, e.g. (None, 1, None, None, 1) for tier 2 & Channel
+    # Built once per combination; blanks are skipped by write_row, and trailing blanks are left off
+    row = FLAG_ROWS.get((tier, category))
+    if row is None:
+        flags = {TIER_COLUMNS.get(tier), CATEGORY_COLUMNS.get(category)} - {None}
+        last = max(flags, default=FIRST_FLAG_COLUMN - 1)
+        row = FLAG_ROWS[(tier, category)] = tuple(1 if col in flags else None
+                                                  for col in range(FIRST_FLAG_COLUMN, last + 1))
+    return row
+
+
+def set_flag_columns(worksheet, center_align):
+    # Centre the flag columns with a column format, so the flags themselves are written without one
+    # Returns {column: format} for ColumnWidths, which sets the column widths at the end
+    formats = {col: center_align for col in range(FIRST_FLAG_COLUMN, len(HEADER))}
+    worksheet.set_column(FIRST_FLAG_COLUMN, len(HEADER) - 1, None, center_align)
+    return formats
+
+
+def export_partitions(db_path="emails.db", key="month", out_dir="reports", workers=None):
+    # One workbook per partition of the articles e.g. per month, written in parallel worker processes
+    # Each worker reads its own slice through its own read-only connection; progress is printed as workbooks finish
+    if key not in PARTITION_KEYS:
+        raise ValueError(f"Unknown partition key: {key}")
+
+    db = connect_readonly(db_path)
+    partitions = db.execute(f"SELECT {PARTITION_KEYS[key]}, COUNT(*) FROM articles a GROUP BY 1").fetchall()
+    db.close()
+
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    results = {}
+    total_rows = 0
+
+    # Largest partitions first, so one big month doesn't start last and hold up the end of the run
+    partitions.sort(key=lambda partition: -partition[1])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for value, articles in partitions:
+            out_path = os.path.join(out_dir, f"{key}_{safe_name(value)}.xlsx")
+            futures[executor.submit(export, db_path, out_path, key=key, value=value)] = value, articles, out_path
+
+        for done, future in enumerate(as_completed(futures), 1):
+            value, articles, out_path = futures[future]
+            try:
+                rows = future.result()
+            except Exception as error:
+                print(f"[{done}/{len(futures)}] {key} {value}: failed -- {error}")
+                continue
+
+            results[value] = out_path
+            total_rows += rows
+            print(f"[{done}/{len(futures)}] {key} {value}: {articles} articles, {rows} rows -> {out_path}")
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {len(results)} of {len(partitions)} workbooks ({total_rows} rows) in {elapsed:.1f}s")
+    return results
+
+
+def connect_readonly(db_path):
+    # Read-only connection, so reports can be written while the parser is adding articles
+    # client_tag() is available to queries as a SQL function
+    db = sqlite3.connect(Path(db_path).absolute().as_uri() + "?mode=ro", uri=True)
+    db.create_function("client_tag", 1, client_tag, deterministic=True)
+    return db
+
+
+def client_tag(path):
+    # Name of the folder, or archive/mbox, an email came from e.g. "acme" for "coverage/acme/june.msg"
+    # and "acme" for "coverage/acme.zip#june.msg"
+    # Maildir emails are in its cur/ or new/ folder, so they get the name of the Maildir e.g. "acme" for
+    # "Maildir/.acme/cur/1687766400.M1.host" (without the leading "." of Maildir++ folders)
+    if not path:
+        return "unknown"
+    if "#" in path:
+        name = os.path.basename(path.split("#", 1)[0])
+        for extension in ARCHIVE_EXTENSIONS + (".mbox",):
+            if name.lower().endswith(extension):
+                name = name[:-len(extension)]
+                break
+        return name or "unknown"
+
+    folder = os.path.dirname(path)
+    if os.path.basename(folder) in ("cur", "new") and is_maildir(os.path.dirname(folder)):
+        return os.path.basename(os.path.dirname(folder)).lstrip(".") or "unknown"
+    return os.path.basename(folder) or "unknown"
+
+
+def safe_name(value):
+    # Partition value as part of a file name
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip("._") or "unknown"
+
+
 def get_extra_rows(db_row_num, links, platforms):
 
     link_counter, link_list, link_id = get_links(links)
@@ -192,18 +375,36 @@ def get_platforms(platforms):
         print(row)
 
 
-def autofit(path):
-    excel = win32.gencache.EnsureDispatch('Excel.Application')
-    excel.Visible = True
-    wb = excel.Workbooks.Open(rf"{path}\out.xlsx")
-    ws = wb.Worksheets("Sheet1")
-    ws.Columns.AutoFit()
-    wb.Save()
-    excel.Workbooks.Open(rf"{path}\out.xlsx")
+class ColumnWidths:
+    # Widest value written to each column, measured in characters
+    # formats are column formats to keep when the widths are set
+    def __init__(self, header, formats=None):
+        self.widths = {}
+        self.formats = formats or {}
+        for col, value in enumerate(header):
+            self.update(col, value)
 
-    # Bring excel sheet to front and maximize (Source: https://stackoverflow.com/questions/19118881)
-    excel.WindowState = win32.constants.xlMinimized
-    excel.WindowState = win32.constants.xlMaximized
+    def update(self, col, value):
+        if value is None:
+            return
+        width = max(len(line) for line in str(value).splitlines() or [""])
+        if width > self.widths.get(col, 0):
+            self.widths[col] = width
+
+    def apply(self, worksheet):
+        # Roughly what Excel's AutoFit gives for the default font, plus a little padding (Excel's maximum is 255)
+        for col, width in self.widths.items():
+            worksheet.set_column(col, col, min(width * 1.1 + 2, 255), self.formats.get(col))
+
+
+def open_workbook(path):
+    # Open the finished workbook in the default spreadsheet application
+    if sys.platform == "win32":
+        os.startfile(path)
+    elif sys.platform == "darwin":
+        subprocess.run(["open", path])
+    else:
+        subprocess.run(["xdg-open", path])
 
 
 def format(workbook):
@@ -220,4 +421,23 @@ def format(workbook):
     return highlight, center_align, red_fill, bold
 
 
-main()
\ No newline at end of file
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Write the articles in the database to Excel")
+    parser.add_argument("--db", default="emails.db", help="SQLite database path (default: emails.db)")
+    parser.add_argument("--out", default="out.xlsx", help="workbook to write without --by (default: out.xlsx)")
+    parser.add_argument("--by", choices=PARTITION_KEYS,
+                        help="write one workbook per month, tier, category or client (folder or archive name)")
+    parser.add_argument("--out-dir", default="reports", help="folder for the --by workbooks (default: reports)")
+    parser.add_argument("--workers", type=int, help="worker processes for --by (default: one per CPU)")
+    parser.add_argument("--open", action="store_true", help="without --by, open the workbook when done")
+    args = parser.parse_args(argv)
+
+    # Without --by, write a single workbook from --db
+    if args.by:
+        export_partitions(args.db, args.by, args.out_dir, args.workers)
+    else:
+        export(args.db, args.out, open_when_done=args.open)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,116 @@
+import json
+import time
+from contextlib import nullcontext
+
+# Per-stage timings and counters for a run -- off unless main() is asked for a summary
+# Usage: with stats.time("date"): ...  /  stats.count("date_fallbacks")
+
+NULL_TIMER = nullcontext()
+
+
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.timers = {}    # stage -> [calls, seconds]
+        self.counters = {}  # name -> count
+        self.emails = {}    # email path -> {stage: seconds}
+        self.email = None   # stage times of the email being worked on
+
+    def time(self, stage):
+        # When disabled this is a shared no-op context manager, so timing a stage costs one call
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, stage)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, stage, seconds, calls=1):
+        timer = self.timers.setdefault(stage, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+        if self.email is not None:
+            self.email[stage] = self.email.get(stage, 0.0) + seconds
+
+    def start_email(self, path):
+        # Following stage times also count towards this email, until the next start_email(None)
+        if self.enabled:
+            self.email = None if path is None else self.emails.setdefault(path, {})
+
+    def take(self):
+        # Hand over everything recorded so far (from a worker process) and start again
+        snapshot = self.timers, self.counters, self.emails
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        timers, counters, emails = snapshot
+        for stage, (calls, seconds) in timers.items():
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        for name, amount in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for path, stages in emails.items():
+            email = self.emails.setdefault(path, {})
+            for stage, seconds in stages.items():
+                email[stage] = email.get(stage, 0.0) + seconds
+
+    def summary(self, elapsed=None):
+        stages = {stage: {"calls": calls, "seconds": round(seconds, 6),
+                          "mean_ms": round(seconds / calls * 1000, 4) if calls else 0}
+                  for stage, (calls, seconds) in sorted(self.timers.items())}
+        return {
+            "elapsed": round(elapsed, 6) if elapsed is not None else None,
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "emails": {path: {stage: round(seconds, 6) for stage, seconds in stages.items()}
+                       for path, stages in self.emails.items()},
+        }
+
+    def write_json(self, path, elapsed=None):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(elapsed), f, indent=2)
+
+    def write_prometheus(self, path, elapsed=None):
+        # Text exposition format, e.g. for node_exporter's textfile collector
+        lines = ["# TYPE coverage_stage_seconds_total counter",
+                 *(f'coverage_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}'
+                   for stage, (_, seconds) in sorted(self.timers.items())),
+                 "# TYPE coverage_stage_calls_total counter",
+                 *(f'coverage_stage_calls_total{{stage="{stage}"}} {calls}'
+                   for stage, (calls, _) in sorted(self.timers.items()))]
+        for name, amount in sorted(self.counters.items()):
+            lines += [f"# TYPE coverage_{name}_total counter", f"coverage_{name}_total {amount}"]
+        if elapsed is not None:
+            lines += ["# TYPE coverage_run_seconds gauge", f"coverage_run_seconds {elapsed:.6f}"]
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class Timer:
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def enable(enabled=True):
+    # Also used as the worker process initializer, as spawned workers don't inherit module state
+    stats.enabled = enabled
+
+
+# Shared by outlook.py and sinks.py
+stats = Stats()
@@ -0,0 +1,99 @@
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import time
+
+# Logging for outlook.main() -- console and log.txt, each with its own level
+# In background mode, log calls only put records on a queue and a listener thread does the writing
+
+FORMAT = "%(levelname)s:%(message)s"
+
+
+class LogSetup:
+    def __init__(self, console_level="DEBUG", file_level="DEBUG", log_path="log.txt", background=True):
+        self.root = logging.getLogger()
+        self.handlers = []
+        self.added = []
+        self.listeners = []
+        self.background = background
+
+        # Same as logging.basicConfig: leave logging alone if it was already set up e.g. by a calling script
+        if self.root.handlers:
+            return
+
+        formatter = logging.Formatter(FORMAT)
+        console = logging.StreamHandler()
+        console.setLevel(console_level)
+        self.handlers.append(console)
+        if log_path:
+            file = logging.FileHandler(log_path)
+            file.setLevel(file_level)
+            self.handlers.append(file)
+        for handler in self.handlers:
+            handler.setFormatter(formatter)
+
+        # Records below every handler's level are dropped before their message is formatted
+        self.level = min(handler.level for handler in self.handlers)
+        self.root.setLevel(self.level)
+
+        if background:
+            log_queue = queue.Queue()
+            self.added.append(logging.handlers.QueueHandler(log_queue))
+            self.start_listener(log_queue)
+        else:
+            self.added.extend(self.handlers)
+
+        for handler in self.added:
+            self.root.addHandler(handler)
+
+        # Write out whatever is still queued if the run stops with an error
+        atexit.register(self.stop)
+
+    def start_listener(self, log_queue):
+        listener = logging.handlers.QueueListener(log_queue, *self.handlers, respect_handler_level=True)
+        listener.start()
+        self.listeners.append(listener)
+
+    def worker_queue(self):
+        # Queue for worker processes to send their records to, or None to let them log as they did before
+        if not (self.background and self.handlers):
+            return None
+        log_queue = multiprocessing.Queue()
+        self.start_listener(log_queue)
+        return log_queue
+
+    def stop(self):
+        # Write out queued records and undo the setup, so the next run starts from scratch
+        atexit.unregister(self.stop)
+        for listener in self.listeners:
+            listener.stop()
+        self.listeners = []
+        for handler in self.added:
+            self.root.removeHandler(handler)
+        for handler in self.handlers:
+            handler.close()
+        self.added = []
+        self.handlers = []
+
+
+def worker_logging(log_queue, level):
+    # Worker process initializer: replace inherited handlers with one that forwards to the main process
+    if log_queue is not None:
+        root = logging.getLogger()
+        root.handlers = [logging.handlers.QueueHandler(log_queue)]
+        root.setLevel(level)
+
+
+class Progress:
+    # Rate-limited progress line, in place of per-email log lines on large folders
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = time.perf_counter()
+
+    def update(self, emails, articles, force=False):
+        now = time.perf_counter()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            logging.info("Processed %d emails, %d articles", emails, articles)
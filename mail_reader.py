@@ -0,0 +1,197 @@
+import binascii
+import email
+import email.header
+import email.utils
+import os
+import re
+
+from msg_reader import Message
+
+# Reader for internet mail: single .eml files, Maildir folders and mbox archives
+# Messages come out as msg_reader.Message, with the same HTML body, sent time and attachment filenames as .msg files
+
+# End of the headers of a message or MIME part
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+# Deepest nesting of multipart parts that is looked into
+MAX_DEPTH = 10
+
+# Reading an mbox this many bytes at a time -- messages are split out of the chunks as they are read
+MBOX_CHUNK_SIZE = 1 << 20
+
+# Lines starting with "From " inside a message are escaped as ">From " (or ">>From " ...) when saved to an mbox
+ESCAPED_FROM = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+def open_eml(path):
+    with open(path, "rb") as f:
+        return read_eml(f.read())
+
+
+def read_eml(data):
+    # Parse one RFC 5322 message given as bytes
+    # Headers are parsed with the email package, but the MIME parts are split out of the bytes with find() --
+    # the email package's parser goes through the message line by line, which is slow for multi-MB bodies
+    head, body = split_headers(data)
+    headers = email.message_from_bytes(head)
+
+    html_body = None
+    filenames = []
+    for part_headers, part_body in walk_parts(headers, body):
+        # Every part with a filename counts as an attachment, including inline images as in Outlook
+        filename = part_headers.get_filename()
+        if filename:
+            filenames.append(decode_header(filename))
+
+        # The first HTML part that isn't an attachment is the body -- emails without one have an empty body,
+        # like a plain text .msg
+        elif html_body is None and part_headers.get_content_type() == "text/html":
+            html_body = decode_body(part_headers, part_body)
+
+    return Message(html_body or "", get_sent_on(headers), filenames)
+
+
+def get_sent_on(headers):
+    # Date header, or the time the email was delivered (the date after the ";" of the newest Received header)
+    # if there's no Date header or it can't be read -- in local time, as Outlook reports SentOn
+    dates = [headers["Date"]]
+    received = headers.get_all("Received")
+    if received:
+        dates.append(received[0].rpartition(";")[2])
+
+    for date in dates:
+        if date:
+            try:
+                return email.utils.parsedate_to_datetime(str(date)).astimezone()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+    return None
+
+
+def walk_parts(headers, body, depth=0):
+    # Yield (headers, body bytes) for each part that isn't itself multipart
+    boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+    if boundary and depth < MAX_DEPTH:
+        for part in split_multipart(body, boundary.encode("ascii", errors="replace")):
+            head, part_body = split_headers(part)
+            yield from walk_parts(email.message_from_bytes(head), part_body, depth + 1)
+    else:
+        yield headers, body
+
+
+def split_headers(data):
+    # Headers end at the first empty line -- a part can also start with one, if it has no headers
+    if data.startswith((b"\n", b"\r\n")):
+        return b"", data[data.find(b"\n") + 1:]
+    match = HEADER_END.search(data)
+    if match is None:
+        return data, b""
+    return data[:match.end()], data[match.end():]
+
+
+def split_multipart(body, boundary):
+    # Parts are separated by "--boundary" lines and end at "--boundary--" (RFC 2046)
+    delimiter = b"--" + boundary
+    if body.startswith(delimiter):
+        position = 0
+    else:
+        position = body.find(b"\n" + delimiter) + 1
+        if not position:
+            return
+
+    while True:
+        after = position + len(delimiter)
+        start = body.find(b"\n", after)
+        if body[after:after + 2] == b"--" or start == -1:
+            return
+
+        end = body.find(b"\n" + delimiter, start)
+        if end == -1:
+            yield body[start + 1:]
+            return
+
+        # The line break before the delimiter belongs to the delimiter
+        yield body[start + 1:end - 1 if body[end - 1:end] == b"\r" else end]
+        position = end + 1
+
+
+def decode_body(headers, body):
+    encoding = (headers["Content-Transfer-Encoding"] or "").strip().lower()
+    try:
+        if encoding == "base64":
+            body = binascii.a2b_base64(body)
+        elif encoding == "quoted-printable":
+            body = binascii.a2b_qp(body)
+    except binascii.Error:
+        pass
+
+    try:
+        return body.decode(headers.get_content_charset() or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("cp1252", errors="replace")
+
+
+def decode_header(value):
+    # Filenames can be MIME encoded words e.g. "=?utf-8?q?26_June_-_Caf=C3=A9.pdf?="
+    if "=?" not in value:
+        return value
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (LookupError, ValueError):
+        return value
+
+
+def is_maildir(path):
+    return os.path.isdir(os.path.join(path, "cur")) and os.path.isdir(os.path.join(path, "new"))
+
+
+def scan_maildir(path):
+    # Delivered messages are in new/ and cur/ -- tmp/ holds messages still being written
+    for folder in ("new", "cur"):
+        with os.scandir(os.path.join(path, folder)) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith("."):
+                    yield entry.path
+
+
+def is_mbox(path):
+    with open(path, "rb") as f:
+        return f.read(5) == b"From "
+
+
+def iter_mbox(path, chunk_size=MBOX_CHUNK_SIZE):
+    # Yield (offset, message bytes) for each message in an mbox, reading the file once from start to end
+    # Only the message being split out (and one chunk) is kept in memory, however large the mbox is
+    with open(path, "rb") as f:
+        data = bytearray(f.read(chunk_size))
+        base = 0    # file offset of data[0]
+        start = 0   # start of the current message in data
+        search = 0  # where to look for the next "From " line
+        while True:
+            end = data.find(b"\nFrom ", search)
+            if end != -1:
+                yield base + start, mbox_message(bytes(data[start:end + 1]))
+                start = search = end + 1
+                continue
+
+            more = f.read(chunk_size)
+            if not more:
+                if data[start:].strip():
+                    yield base + start, mbox_message(bytes(data[start:]))
+                return
+
+            # Drop what was already handed out (cheap at the front of a bytearray) and look again from just
+            # before the new chunk, so a message spanning many chunks isn't copied for each one
+            search = max(len(data) - start - len(b"\nFrom "), 1)
+            del data[:start]
+            data += more
+            base += start
+            start = 0
+
+
+def mbox_message(data):
+    # Remove the "From " separator line and undo the escaping of "From " lines
+    data = data[data.find(b"\n") + 1:]
+    if b">From " in data:
+        data = ESCAPED_FROM.sub(rb"\1", data)
+    return data
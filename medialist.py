@@ -0,0 +1,208 @@
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+# In-memory index of the medialist table, used by get_tiercat to resolve links to tier & category
+
+
+class MediaIndex:
+    def __init__(self, rows):
+        # Reversed-label trie of hosts e.g. sg -> com -> hardwarezone, each node holding (row, path, tier, type)
+        self.root = {}
+        self.hits = 0
+        self.misses = 0
+
+        # Hosts with entries for part of the site only e.g. bbc.com/news
+        self.path_hosts = set()
+
+        for position, (url, tier, category) in enumerate(rows):
+            host, path = split_url(url)
+            if not host:
+                continue
+
+            node = self.root
+            for label in reversed(host.split(".")):
+                node = node.setdefault(label, {})
+            node.setdefault(None, []).append((position, path, tier, category))
+            if path:
+                self.path_hosts.add(host)
+
+    def lookup(self, link):
+        return self.lookup_host(*split_url(link))
+
+    def lookup_host(self, host, path):
+        best = None
+
+        # Walk down the trie one label at a time -- every entry on the way is a parent domain of the link
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+
+            # Where several entries match, the first row in the medialist table wins (same as a table scan)
+            for entry in node.get(None, ()):
+                if path.startswith(entry[1]) and (best is None or entry[0] < best[0]):
+                    best = entry
+
+        if best is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return best[2], best[3]
+
+    def cache_key(self, host, path):
+        # Links to the same host resolve the same way, unless the host (or a parent domain) has path entries
+        labels = host.split(".")
+        for i in range(len(labels)):
+            if ".".join(labels[i:]) in self.path_hosts:
+                return host + path
+        return host
+
+
+def split_url(url):
+    # Return lowercase host and path without trailing slash e.g. ("www.bbc.com", "/news/world/asia")
+    url = url.strip().lower()
+    if "//" not in url:
+        url = "//" + url
+
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+    except ValueError:
+        return "", ""
+
+    return host, parts.path.rstrip("/")
+
+
+# Second-level labels that come before a country code e.g. bbc.co.uk, hardwarezone.com.sg
+GENERIC_LABELS = {"com", "net", "org", "co", "gov", "edu", "ac"}
+
+
+class NameMatcher:
+    # Trie over normalized outlet names e.g. "hardwarezone" for hardwarezone.com.sg
+    def __init__(self, rows):
+        self.root = {}
+
+        for position, (url, tier, category) in enumerate(rows):
+            name = get_name(url)
+            if not name:
+                continue
+
+            node = self.root
+            for char in name:
+                node = node.setdefault(char, {})
+            # Where several rows have the same name, the first row in the medialist table wins
+            node.setdefault(None, (tier, category))
+
+    def lookup(self, publication):
+        # Walk the trie along the normalized publication, one word at a time from the first word
+        # Like the old checks, a name has to cover the whole publication name or its first word(s) -- it must start
+        # at the start of the publication and end at the end of a word, so "time" doesn't match "The Straits Times"
+        # or "Timeout". The longest name wins, e.g. outletcx.com over outletc.com for "Outletcx Online".
+        # Dots end a word too, so publications named after their site e.g. "CNET.com" or "Mothership.sg" match
+        best = None
+        node = self.root
+        for word in publication.replace(".", " ").split():
+            for char in normalize(word):
+                node = node.get(char)
+                if node is None:
+                    return best
+            best = node.get(None, best)
+        return best
+
+
+def normalize(name):
+    # Case-fold and strip spaces & punctuation e.g. "HardwareZone Singapore" -> "hardwarezonesingapore", "E27" -> "e27"
+    return "".join(char for char in name.casefold() if "a" <= char <= "z" or "0" <= char <= "9")
+
+
+def get_name(url):
+    # Outlet name from a medialist URL e.g. news.cnet.com -> cnet, bbc.co.uk -> bbc
+    host, _ = split_url(url)
+    labels = host.split(".")
+    if len(labels) > 1:
+        labels.pop()
+    while len(labels) > 1 and labels[-1] in GENERIC_LABELS:
+        labels.pop()
+    return normalize(labels[-1]) if labels else ""
+
+
+def name_key(publication):
+    # Case-folded words of a publication name -- NameMatcher gives the same result for the same words
+    return " ".join(publication.casefold().split())
+
+
+def medialist_hash(rows):
+    # Hash of the medialist table, in row order (earlier rows win in lookups)
+    digest = hashlib.sha1()
+    for url, tier, category in rows:
+        digest.update(f"{url}\t{tier}\t{category}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class TierCache:
+    # Resolved (tier, category, source) per (link host, publication name), where source is the check that matched
+    # ("link", "name" or "none"). Recent results are kept in memory (LRU), all of them in the tiercat_cache table.
+    # The table is cleared whenever the medialist changes, or the way results are resolved changes (VERSION).
+    VERSION = 3
+
+    def __init__(self, db, rows, size=100000):
+        self.db = db
+        self.size = size
+        self.memory = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+        current = f"{self.VERSION}:{medialist_hash(rows)}"
+        stored = db.execute("SELECT value FROM metadata WHERE key = 'tiercat_cache'").fetchone()
+        if stored is None or stored[0] != current:
+            db.execute("DELETE FROM tiercat_cache")
+            db.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('tiercat_cache', ?)", (current,))
+            db.commit()
+
+        # Load saved results up front -- one query is much cheaper than one per key
+        for host, publication, tier, category, source in db.execute(
+                "SELECT host, publication, tier, category, source FROM tiercat_cache LIMIT ?", (size,)):
+            self.memory[host, publication] = (tier, category, source)
+
+        # If the whole table fits in memory, there's no need to look for misses in the table
+        self.complete = len(self.memory) < size
+
+    def get(self, key):
+        result = self.memory.get(key)
+        if result is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return result
+        if self.complete:
+            self.misses += 1
+            return None
+
+        row = self.db.execute("SELECT tier, category, source FROM tiercat_cache WHERE host = ? AND publication = ?",
+                              key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.remember(key, row)
+        return row
+
+    def put(self, key, result):
+        # Saved to the table with the next flush(), which outlook.write_batch() calls before committing
+        self.remember(key, result)
+        self.pending.append(key + tuple(result))
+
+    def remember(self, key, result):
+        self.memory[key] = result
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+            self.complete = False
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO tiercat_cache (host, publication, tier, category, source) "
+                            "VALUES (?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
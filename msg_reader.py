@@ -0,0 +1,422 @@
+import mmap
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+
+# Native reader for Outlook .msg files (OLE/Compound File Binary format)
+# Only decodes the streams used by the parser: HTML body, sent time and attachment filenames
+# Spec references: [MS-CFB] (container), [MS-OXMSG] (message layout), [MS-OXRTFCP] & [MS-OXRTFEX] (RTF body)
+
+CFB_SIGNATURE = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+# Special sector numbers in the FAT
+MAX_REG_SECT = 0xFFFFFFFA
+NO_STREAM = 0xFFFFFFFF
+
+# Directory entry types
+STORAGE = 1
+STREAM = 2
+ROOT = 5
+
+# MAPI property tags used by the parser
+PR_CLIENT_SUBMIT_TIME = 0x00390040
+PR_MESSAGE_DELIVERY_TIME = 0x0E060040
+PR_INTERNET_CPID = 0x3FDE0003
+HTML_STREAMS = ["__substg1.0_10130102", "__substg1.0_1013001F", "__substg1.0_1013001E"]
+RTF_STREAM = "__substg1.0_10090102"
+FILENAME_STREAMS = ["__substg1.0_3707001F", "__substg1.0_3707001E",
+                    "__substg1.0_3704001F", "__substg1.0_3704001E"]
+
+# FILETIME epoch (100ns intervals since 1601-01-01)
+FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+
+
+class MsgError(Exception):
+    pass
+
+
+class Attachment:
+    def __init__(self, filename):
+        self.Filename = filename
+
+
+class Attachments:
+    # Mirror the COM collection: Count property and 1-based Item()
+    def __init__(self, items):
+        self._items = items
+        self.Count = len(items)
+
+    def Item(self, index):
+        return self._items[index - 1]
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class Message:
+    # Exposes the same attributes that outlook.py reads from an Outlook MailItem
+    # html_body can also be the raw bytes of the HTML stream, which are only decoded if HTMLBody is read --
+    # the parser scans raw_body directly (see outlook.find_list_items)
+    def __init__(self, html_body, sent_on, filenames, codepage=None):
+        self.raw_body = html_body
+        self.codepage = codepage
+        self.SentOn = sent_on
+        self.Attachments = Attachments([Attachment(f) for f in filenames])
+
+    @property
+    def HTMLBody(self):
+        if isinstance(self.raw_body, bytes):
+            self.raw_body = decode_html(self.raw_body, self.codepage)
+        return self.raw_body
+
+
+def open_msg(path):
+    # Memory-map the file and only copy out the streams we need
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return read_msg(buffer)
+
+
+def read_msg(buffer):
+    cfb = CompoundFile(buffer)
+    root = cfb.children(0)
+
+    # HTML body: prefer PR_HTML (kept as bytes until needed), otherwise decode it from the compressed RTF body
+    html_body = ""
+    codepage = None
+    for name in HTML_STREAMS:
+        if name in root:
+            data = cfb.read(root[name])
+            if name.endswith("001F"):
+                html_body = data.decode("utf-16-le", errors="replace")
+            else:
+                html_body = data
+                codepage = get_codepage(cfb, root)
+            break
+    else:
+        if RTF_STREAM in root:
+            rtf = decompress_rtf(cfb.read(root[RTF_STREAM]))
+            html_body = rtf_to_html(rtf)
+
+    # Sent time from the top-level property stream (32 byte header)
+    # Drafts and some exported emails have no sent time, so fall back to the time the email was delivered
+    props = {}
+    if "__properties_version1.0" in root:
+        props = read_properties(cfb.read(root["__properties_version1.0"]), 32)
+    sent_on = None
+    for tag in (PR_CLIENT_SUBMIT_TIME, PR_MESSAGE_DELIVERY_TIME):
+        if props.get(tag):
+            sent_on = filetime_to_datetime(props[tag])
+            break
+
+    # Attachment filenames, in attachment number order
+    filenames = []
+    for name in sorted(n for n in root if n.startswith("__attach_version1.0_#")):
+        attach = cfb.children(root[name])
+        filenames.append(get_filename(cfb, attach))
+
+    return Message(html_body, sent_on, filenames, codepage)
+
+
+def get_codepage(cfb, root):
+    if "__properties_version1.0" in root:
+        props = read_properties(cfb.read(root["__properties_version1.0"]), 32)
+        if PR_INTERNET_CPID in props:
+            return f"cp{props[PR_INTERNET_CPID] & 0xFFFFFFFF}"
+    return None
+
+
+def decode_html(data, codepage):
+    data = data.rstrip(b"\x00")
+    if codepage == "cp65001" or codepage is None:
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError:
+            codepage = "cp1252"
+    try:
+        return data.decode(codepage, errors="replace")
+    except LookupError:
+        return data.decode("cp1252", errors="replace")
+
+
+def get_filename(cfb, attach):
+    for name in FILENAME_STREAMS:
+        if name in attach:
+            data = cfb.read(attach[name])
+            if name.endswith("001F"):
+                return data.decode("utf-16-le", errors="replace").rstrip("\x00")
+            return data.decode("cp1252", errors="replace").rstrip("\x00")
+    return ""
+
+
+def read_properties(data, header_size):
+    # Fixed-length property entries: tag (4), flags (4), value (8)
+    props = {}
+    for offset in range(header_size, len(data) - 15, 16):
+        tag, = struct.unpack_from("<I", data, offset)
+        value, = struct.unpack_from("<q", data, offset + 8)
+        props[tag] = value
+    return props
+
+
+def filetime_to_datetime(filetime):
+    # Outlook reports SentOn in local time
+    return (FILETIME_EPOCH + timedelta(microseconds=filetime // 10)).astimezone()
+
+
+class CompoundFile:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if bytes(buffer[:8]) != CFB_SIGNATURE:
+            raise MsgError("Not an OLE compound file")
+
+        (sector_shift, mini_shift) = struct.unpack_from("<HH", buffer, 0x1E)
+        (num_fat, first_dir, _, self.mini_cutoff, first_minifat, num_minifat,
+         first_difat, num_difat) = struct.unpack_from("<IIIIIIII", buffer, 0x2C)
+        self.sector_size = 1 << sector_shift
+        self.mini_size = 1 << mini_shift
+
+        # Build the FAT from the header DIFAT plus any DIFAT sectors
+        per_sector = self.sector_size // 4
+        fat_sectors = list(struct.unpack_from("<109I", buffer, 0x4C))
+        sector = first_difat
+        for _ in range(num_difat):
+            if sector >= MAX_REG_SECT:
+                break
+            entries = struct.unpack_from(f"<{per_sector}I", buffer, self.offset(sector))
+            fat_sectors.extend(entries[:-1])
+            sector = entries[-1]
+
+        self.fat = []
+        for sector in fat_sectors[:num_fat]:
+            self.fat.extend(struct.unpack_from(f"<{per_sector}I", buffer, self.offset(sector)))
+
+        # Directory entries
+        directory = self.read_chain(first_dir)
+        self.entries = []
+        for offset in range(0, len(directory) - 127, 128):
+            name_len, entry_type = struct.unpack_from("<HB", directory, offset + 64)
+            left, right, child = struct.unpack_from("<III", directory, offset + 68)
+            start, size = struct.unpack_from("<IQ", directory, offset + 116)
+            if self.sector_size == 512:
+                size &= 0xFFFFFFFF
+            name = directory[offset:offset + max(name_len - 2, 0)].decode("utf-16-le", errors="replace")
+            self.entries.append((name, entry_type, left, right, child, start, size))
+
+        # Mini FAT and mini stream (stored in the root entry's chain)
+        self.minifat = []
+        if num_minifat and first_minifat < MAX_REG_SECT:
+            data = self.read_chain(first_minifat)
+            self.minifat = list(struct.unpack_from(f"<{len(data) // 4}I", data))
+        root = self.entries[0]
+        self.ministream = self.read_chain(root[5], root[6]) if root[6] else b""
+
+    def offset(self, sector):
+        return (sector + 1) * self.sector_size
+
+    def read_chain(self, sector, size=None):
+        chunks = []
+        seen = 0
+        while sector < MAX_REG_SECT and seen <= len(self.fat):
+            start = self.offset(sector)
+            chunks.append(self.buffer[start:start + self.sector_size])
+            sector = self.fat[sector]
+            seen += 1
+        data = b"".join(chunks)
+        return data if size is None else data[:size]
+
+    def read_mini_chain(self, sector, size):
+        chunks = []
+        seen = 0
+        while sector < MAX_REG_SECT and seen <= len(self.minifat):
+            start = sector * self.mini_size
+            chunks.append(self.ministream[start:start + self.mini_size])
+            sector = self.minifat[sector]
+            seen += 1
+        return b"".join(chunks)[:size]
+
+    def read(self, entry_id):
+        _, _, _, _, _, start, size = self.entries[entry_id]
+        if size == 0:
+            return b""
+        if size < self.mini_cutoff:
+            return self.read_mini_chain(start, size)
+        return self.read_chain(start, size)
+
+    def children(self, entry_id):
+        # Walk the red-black tree of a storage and map child names to entry ids
+        result = {}
+        stack = [self.entries[entry_id][4]]
+        while stack:
+            current = stack.pop()
+            if current == NO_STREAM or current >= len(self.entries) or current in result.values():
+                continue
+            name, entry_type, left, right, _, _, _ = self.entries[current]
+            if entry_type in (STORAGE, STREAM):
+                result[name] = current
+            stack.append(left)
+            stack.append(right)
+        return result
+
+
+# Initial dictionary for compressed RTF ([MS-OXRTFCP] 2.1.2.1)
+RTF_PREBUF = (b"{\\rtf1\\ansi\\mac\\deff0\\deftab720{\\fonttbl;}{\\f0\\fnil \\froman \\fswiss "
+              b"\\fmodern \\fscript \\fdecor MS Sans SerifSymbolArialTimes New RomanCourier"
+              b"{\\colortbl\\red0\\green0\\blue0\r\n\\par \\pard\\plain\\f0\\fs20\\b\\i\\u\\tab\\tx")
+COMPRESSED = 0x75465A4C
+UNCOMPRESSED = 0x414C454D
+
+
+def decompress_rtf(data):
+    comp_size, raw_size, comp_type, _ = struct.unpack_from("<IIII", data)
+    if comp_type == UNCOMPRESSED:
+        return bytes(data[16:16 + raw_size])
+    if comp_type != COMPRESSED:
+        raise MsgError("Unknown compressed RTF format")
+
+    dictionary = bytearray(RTF_PREBUF.ljust(4096, b"\x00"))
+    write = len(RTF_PREBUF)
+    out = bytearray()
+    pos = 16
+    end = min(len(data), comp_size + 4)
+
+    while pos < end:
+        control = data[pos]
+        pos += 1
+        for bit in range(8):
+            if pos >= end:
+                break
+            if control & (1 << bit):
+                # Dictionary reference: 12 bit offset, 4 bit length
+                token = (data[pos] << 8) | data[pos + 1]
+                pos += 2
+                read = token >> 4
+                length = (token & 0xF) + 2
+                if read == write:
+                    return bytes(out)
+                for _ in range(length):
+                    char = dictionary[read]
+                    out.append(char)
+                    dictionary[write] = char
+                    read = (read + 1) & 0xFFF
+                    write = (write + 1) & 0xFFF
+            else:
+                char = data[pos]
+                pos += 1
+                out.append(char)
+                dictionary[write] = char
+                write = (write + 1) & 0xFFF
+    return bytes(out)
+
+
+# RTF tokens: control word, control symbol / hex escape, group delimiters, plain text
+RTF_TOKEN = re.compile(rb"\\([a-zA-Z]+)(-?\d+)? ?|\\'([0-9a-fA-F]{2})|\\(.)|([{}])|([^\\{}\r\n]+)|[\r\n]+", re.S)
+
+# Destinations that never contain HTML content
+RTF_SKIP = {b"fonttbl", b"colortbl", b"stylesheet", b"info", b"pict", b"listtable",
+            b"listoverridetable", b"rsidtbl", b"generator", b"themedata", b"latentstyles",
+            b"datastore", b"xmlnstbl", b"pntext", b"pntxta", b"pntxtb", b"mhtmltag"}
+
+
+def rtf_to_html(rtf):
+    # De-encapsulate HTML from RTF generated with \fromhtml1 ([MS-OXRTFEX] 2.4.2)
+    if b"\\fromhtml" not in rtf[:1024]:
+        return ""
+
+    codepage = "cp1252"
+    match = re.search(rb"\\ansicpg(\d+)", rtf[:1024])
+    if match:
+        codepage = f"cp{int(match.group(1))}"
+
+    out = []
+    pending = bytearray()
+
+    def flush():
+        if pending:
+            try:
+                out.append(pending.decode(codepage, errors="replace"))
+            except LookupError:
+                out.append(pending.decode("cp1252", errors="replace"))
+            pending.clear()
+
+    # Group state: (skip destination, suppressed by \htmlrtf, unicode skip count)
+    skip, suppressed, uc = False, False, 1
+    stack = []
+    group_start = False
+    skip_chars = 0
+
+    for m in RTF_TOKEN.finditer(rtf):
+        word, param, hexcode, symbol, brace, text = m.groups()
+
+        if brace == b"{":
+            stack.append((skip, suppressed, uc))
+            group_start = True
+            continue
+        if brace == b"}":
+            if stack:
+                skip, suppressed, uc = stack.pop()
+            group_start = False
+            continue
+
+        first = group_start
+        group_start = False
+
+        if word is not None:
+            if first and word in RTF_SKIP:
+                skip = True
+            elif word == b"htmlrtf":
+                suppressed = param != b"0"
+            elif word == b"uc":
+                uc = int(param or 1)
+            elif skip or suppressed:
+                continue
+            elif word == b"u":
+                flush()
+                code = int(param)
+                out.append(chr(code + 65536 if code < 0 else code))
+                skip_chars = uc
+            elif word == b"par" or word == b"line":
+                flush()
+                out.append("\r\n")
+            elif word == b"tab":
+                flush()
+                out.append("\t")
+            continue
+
+        if symbol is not None:
+            # \*\destination: only htmltag destinations carry HTML
+            if first and symbol == b"*":
+                nxt = rtf[m.end():m.end() + 12]
+                if not nxt.startswith(b"\\htmltag"):
+                    skip = True
+                group_start = True
+                continue
+            if skip or suppressed:
+                continue
+            if skip_chars:
+                skip_chars -= 1
+            elif symbol in (b"\\", b"{", b"}"):
+                pending.extend(symbol)
+            elif symbol == b"~":
+                pending.extend(b"\xa0")
+            continue
+
+        if skip or suppressed:
+            continue
+
+        if hexcode is not None:
+            if skip_chars:
+                skip_chars -= 1
+            else:
+                pending.append(int(hexcode, 16))
+            continue
+
+        if text is not None:
+            if skip_chars:
+                drop = min(skip_chars, len(text))
+                text = text[drop:]
+                skip_chars -= drop
+            pending.extend(text)
+
+    flush()
+    return "".join(out)
@@ -1,143 +1,722 @@
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
-
-import win32com.client
-import sqlite3
 import html
 
 import re
-import fnmatch
 import os
+import sys
+import glob
+import argparse
+import hashlib
+import time
+import queue
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
 
 from setup_db import setup
+from msg_reader import open_msg, read_msg, decode_html
+from mail_reader import open_eml, read_eml, is_maildir, scan_maildir, is_mbox, iter_mbox
+from archive_reader import is_archive, iter_archive, ARCHIVE_ERRORS
+from medialist import MediaIndex, NameMatcher, TierCache, split_url, name_key
+from sinks import SQLiteSink, DUPLICATE_POLICIES, open_sink
+from records import Article
+from instrument import stats, enable
+from logs import LogSetup, Progress, worker_logging
+
+# Database connection, set up by main() -- only the main process writes to it
+db = None
+
+# Indexes of the medialist table by link and by publication name, built once per run
+media_index = None
+name_matcher = None
+
+# Tier & category already resolved in this or previous runs
+tiercat_cache = None
+
+def main(inputs=None, db_path="emails.db", medialist_path="medialist.csv", use_outlook=False,
+         workers=1, batch_size=100, incremental=False, outputs=(), stats_path=None, prometheus_path=None,
+         console_level="DEBUG", file_level="DEBUG", log_path="log.txt", log_background=True, progress_interval=None,
+         duplicates="suffix"):
+    run_start = time.perf_counter()
+    sinks, log_setup, outlook = start(db_path, medialist_path, use_outlook, incremental, outputs,
+                                      bool(stats_path or prometheus_path), console_level, file_level, log_path,
+                                      log_background, duplicates)
+
+    # Show dialog box and return folder path, unless emails were given e.g. on the command line
+    if inputs is None:
+        inputs = [ask_folder()]
+
+    # In incremental mode, skip emails that haven't changed since they were last processed
+    # (also resumes an interrupted run, as each batch is committed together with its processed_files rows)
+    known = load_known() if incremental else None
+
+    totals = Totals()
+    ingest(inputs, totals, sinks, outlook, workers, batch_size, known, log_setup, progress_interval)
+    finish(totals, sinks, log_setup, run_start, stats_path, prometheus_path)
+
+
+def start(db_path="emails.db", medialist_path="medialist.csv", use_outlook=False, incremental=False, outputs=(),
+          stats_enabled=False, console_level="DEBUG", file_level="DEBUG", log_path="log.txt", log_background=True,
+          duplicates="suffix"):
+    # Set up everything that stays the same for the whole run: database, medialist indexes, sinks and logging
+    # Returns (sinks, log_setup, outlook) -- the database and indexes are module globals
+    global db, media_index, name_matcher, tiercat_cache
+
+    # Time each stage and count fallbacks only if a summary was asked for
+    stats.reset()
+    enable(stats_enabled)
+
+    # Setup database -- in incremental mode, keep articles from previous runs
+    db = setup(incremental, db_path, medialist_path)
+    medialist = db.execute("SELECT url, tier, type FROM medialist ORDER BY position, rowid").fetchall()
+    media_index = MediaIndex(medialist)
+    name_matcher = NameMatcher(medialist)
+    tiercat_cache = TierCache(db, medialist)
+
+    # Write to the database plus any extra output files (.jsonl, .csv, .parquet) in the same pass
+    # Repeated articles are kept with a "(2)" title suffix, merged into the first one or skipped (see SQLiteSink)
+    sinks = [SQLiteSink(db, duplicates)] + [open_sink(path) for path in outputs]
+
+    # Setup logger -- output to txt file and console, written from a background thread unless log_background=False
+    log_setup = LogSetup(console_level, file_level, log_path, log_background)
+
+    # Connect to Outlook by MAPI only if requested -- otherwise read .msg files natively
+    outlook = None
+    if use_outlook:
+        import win32com.client
+        outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+
+    return sinks, log_setup, outlook
+
+
+class Totals:
+    # Emails, articles and time spent per worker process, added up over every ingest() of a run
+    def __init__(self):
+        self.emails = 0
+        self.articles = 0
+        self.failed = 0
+        self.workers = {}  # pid -> [emails, articles, seconds]
+
+
+def load_known(paths=None):
+    # processed_files rows as {path: (size, mtime, hash)} -- for every email, or only those in paths
+    # (including emails inside paths that are mboxes or archives, stored as "path#member")
+    query = "SELECT path, size, mtime, hash FROM processed_files"
+    if paths is None:
+        return {row[0]: row[1:] for row in db.execute(query)}
+
+    known = {}
+    for path in paths:
+        # "#" sorts just before "$", so the range picks out "path#..." using the primary key index
+        for row in db.execute(query + " WHERE path = ? OR (path > ? AND path < ?)", (path, path + "#", path + "$")):
+            known[row[0]] = row[1:]
+    return known
+
+
+def ingest(inputs, totals, sinks, outlook=None, workers=1, batch_size=100, known=None, log_setup=None,
+           progress_interval=None, executor=None):
+    # Parse the emails in inputs (files, folders, globs ...) and write their articles to the sinks
+    # With known (see load_known), unchanged emails are skipped and known emails that are gone from the folders,
+    # mboxes and archives in inputs are removed
+    # Stream emails through the pipeline: scan folders -> stat & hash -> extract -> resolve & write
+    # Stages are generators linked by bounded queues, so memory use doesn't grow with the number of emails
+    folders = set()
+
+    # Scanning folders and hashing files runs in a background thread, a few dozen emails ahead of the parser
+    files = background(check_files(scan_paths(inputs, folders), known), maxsize=QUEUE_SIZE)
+
+    # Extract articles in this process, or in a pool of workers (COM objects can't be shared across processes)
+    if workers > 1 and outlook is None:
+        log_queue = log_setup.worker_queue() if log_setup and executor is None else None
+        log_level = log_setup.root.level if log_setup else logging.DEBUG
+        results = extract_parallel(skip_unchanged(files), workers, log_queue, log_level, executor)
+    else:
+        results = ((path, info, extract_email(path, outlook, data)) for path, info, data in skip_unchanged(files))
+
+    batch = []
+    batch_count = 0
+
+    # With a progress interval, per-email lines drop to debug and a summary line is logged every few seconds instead
+    progress = Progress(progress_interval) if progress_interval else None
+    email_level = logging.DEBUG if progress else logging.INFO
+
+    # Iterate through every email -- results arrive in the same order as the emails were found
+    for path, info, (name, articles, elapsed, pid, snapshot) in results:
+        # Stage timings from the worker that parsed this email
+        if snapshot:
+            stats.merge(snapshot)
+
+        # Emails that could not be read are left out of processed_files, so they're tried again next run
+        if articles is None:
+            totals.failed += 1
+            stats.count("failed_emails")
+            continue
+
+        totals.emails += 1
+
+        logging.log(email_level, name)
+        num_coverage = len(articles)
 
-# Setup database
-db = setup()
-
-def main():
+        # Check for alternate coding with quotes
+        if num_coverage == 0:
+            logging.warning("No coverage found in %s", name)
 
-    # Setup logger -- output to txt file and console
-    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG, 
-                        handlers=[logging.FileHandler("log.txt"), logging.StreamHandler()])
-    
-    # Connect to Outlook by MAPI
-    outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+        # Keep track of total amount of coverage
+        totals.articles += num_coverage
+
+        logging.log(email_level, "Processing email #%d", totals.emails)
+        logging.log(email_level, "Coverage: %d articles\n", num_coverage)
+        if progress:
+            progress.update(totals.emails, totals.articles)
+
+        worker = totals.workers.setdefault(pid, [0, 0, 0.0])
+        worker[0] += 1
+        worker[1] += num_coverage
+        worker[2] += elapsed
+
+        stats.count("emails")
+        stats.count("articles", num_coverage)
+
+        # Single writer: insert articles in batches, committing each one (also when emails have no articles)
+        batch.append((path, info, articles))
+        batch_count += num_coverage
+        if batch_count >= batch_size or len(batch) >= batch_size:
+            write_batch(batch, sinks)
+            batch = []
+            batch_count = 0
+
+    if progress:
+        progress.update(totals.emails, totals.articles, force=True)
+
+    write_batch(batch, sinks)
+    if known is not None:
+        forget_deleted(known, folders, sinks[0])
+
+
+def finish(totals, sinks, log_setup, run_start, stats_path=None, prometheus_path=None):
+    # Close the sinks, log the run summary and write the stats files
+    for sink in sinks:
+        sink.close()
+
+    logging.info(f"Number of emails = {totals.emails}")
+    logging.info(f"Total coverage: {totals.articles}")
+    if totals.failed:
+        logging.warning(f"Could not read {totals.failed} emails, see the errors above")
+    report_throughput(totals.workers)
+    logging.info(f"Medialist index: {media_index.hits} hits, {media_index.misses} misses")
+    lookups = tiercat_cache.hits + tiercat_cache.misses
+    if lookups:
+        logging.info(f"Tier/category cache: {tiercat_cache.hits} hits, {tiercat_cache.misses} misses "
+                     f"({tiercat_cache.hits / lookups:.0%} hit rate)")
+
+    elapsed = time.perf_counter() - run_start
+    if stats_path:
+        stats.write_json(stats_path, elapsed)
+        logging.info(f"Run summary written to {stats_path}")
+    if prometheus_path:
+        stats.write_prometheus(prometheus_path, elapsed)
+
+    log_setup.stop()
+
+
+def ask_folder():
+    # Tk is only needed for the folder dialog, so import it here
+    from tkinter import Tk
+    from tkinter.filedialog import askdirectory
 
-    # Show dialog box and return folder path
     Tk().withdraw()
-    folder_path = os.path.normpath(askdirectory(title='Select Folder'))
+    return os.path.normpath(askdirectory(title='Select Folder'))
+
+
+# Emails waiting between stages: scanned & hashed emails, and emails per task for worker processes
+# Emails from an mbox wait with their message bytes, so QUEUE_SIZE also bounds memory use
+QUEUE_SIZE = 64
+CHUNK_SIZE = 16
+
+
+def scan_paths(inputs, folders):
+    # Lazily expand folders, globs, email files, mboxes and zip/tar archives into (path, data) -- "-" reads a list of
+    # files from stdin
+    # data is None for emails in their own file, or the message bytes for emails read out of an mbox or archive,
+    # whose path is the mbox path and the message offset e.g. "archive.mbox#52064", or the archive path and the
+    # member name e.g. "batch.zip#june/coverage.msg"
+    # Folders, mboxes and archives that were given are added to folders (to spot deleted emails in incremental mode)
+    # A single folder can't list an email twice, so only remember paths when there are several inputs
+    seen = set() if len(inputs) > 1 or "-" in inputs else None
+
+    for item in inputs:
+        if item == "-":
+            items = (line.strip() for line in sys.stdin if line.strip())
+        elif glob.has_magic(item):
+            items = glob.iglob(item)
+        else:
+            items = [item]
+
+        for path in items:
+            path = os.path.abspath(path)
+            if os.path.isdir(path):
+                found = scan_folder(path, folders)
+            elif os.path.isfile(path):
+                found = scan_file(path, folders)
+            else:
+                logging.warning(f"No such file or folder: {path}")
+                found = []
+
+            for path, data in found:
+                if seen is None:
+                    yield path, data
+                elif path not in seen:
+                    seen.add(path)
+                    yield path, data
+
+
+def scan_folder(folder, folders):
+    # A Maildir keeps its emails in new/ and cur/, one file each
+    if is_maildir(folder):
+        folders.update(os.path.join(folder, name) for name in ("new", "cur"))
+        for path in scan_maildir(folder):
+            yield path, None
+        return
+
+    # os.scandir reads the folder as it goes, unlike os.listdir which builds the whole list first
+    folders.add(folder)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith((".msg", ".eml")):
+                yield entry.path, None
+            elif entry.name.endswith(".mbox"):
+                yield from scan_mbox(entry.path, folders)
+            elif is_archive(entry.name):
+                yield from scan_archive(entry.path, folders)
+
+
+def scan_file(path, folders):
+    # mbox archives are recognised by extension, or by the "From " line they start with
+    if is_archive(path):
+        yield from scan_archive(path, folders)
+    elif path.endswith(".mbox") or (not path.endswith((".msg", ".eml")) and is_mbox(path)):
+        yield from scan_mbox(path, folders)
+    else:
+        yield path, None
+
+
+def scan_mbox(path, folders):
+    # Split messages out of the mbox in a single pass over the file, as (path#offset, message bytes)
+    folders.add(path)
+    for offset, data in iter_mbox(path):
+        yield f"{path}#{offset}", data
+
+
+def scan_archive(path, folders):
+    # Stream .msg and .eml members out of a zip or tar archive, as (path#member, member bytes)
+    # The archive is only added to folders once it has been read to the end -- members of a damaged archive
+    # can't be told apart from deleted ones, so their articles are kept until the archive can be read again
+    try:
+        for member, data in iter_archive(path):
+            yield f"{path}#{member}", data
+    except ARCHIVE_ERRORS as error:
+        logging.error(f"Could not read archive {path}, keeping articles from its emails: {error}")
+        return
+    folders.add(path)
+
+
+def check_files(items, known=None):
+    # Pair each email with its (size, mtime, hash) as (path, info, data, changed)
+    # With known (incremental mode), emails with the same size & modified time are skipped without reading them,
+    # and emails that were touched but have the same content come through with changed=False
+    # Emails from an mbox have no modified time of their own, so they are compared by hash only
+    for path, data in items:
+        if known is None:
+            yield path, get_file_info(path, data), data, True
+            continue
+
+        previous = known.pop(path, None)
+        if data is None:
+            stat = os.stat(path)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+                continue
+
+        info = get_file_info(path, data)
+        if data is not None and previous and previous[2] == info[2]:
+            continue
+        yield path, info, data, not (previous and previous[2] == info[2])
+
+
+def skip_unchanged(files):
+    # Touched but same content -- update the manifest only
+    for path, info, data, changed in files:
+        if changed:
+            yield path, info, data
+        else:
+            db.execute("UPDATE processed_files SET size = ?, mtime = ? WHERE path = ?", (info[0], info[1], path))
+
 
-    # Init & populate list of emails
-    email_list = [file for file in os.listdir(folder_path) if file.endswith(".msg")]
+def forget_deleted(known, folders, sink):
+    # Emails that were processed before but are no longer in the folder (or mbox/archive)
+    # Removed through the database sink, so its index of articles stays in step with the table
+    for path in known:
+        if is_deleted(path, folders):
+            logging.info(f"Removing articles from deleted email {email_name(path)}")
+            sink.forget(path)
+    db.commit()
 
-    # Get total emails by filtering for files in directory with the .msg extension
-    email_total = len(fnmatch.filter(os.listdir(folder_path), '*.msg'))
-    logging.info(f"Number of emails in directory = {email_total}")
 
-    # Create counter to track total number of coverage
-    total_coverage = 0
+def is_deleted(path, folders):
+    # An email from an mbox or archive that is still there is only gone if the mbox/archive was read to the end
+    # (see scan_archive) -- otherwise, an email is gone if the folder it (or its mbox/archive) was in was scanned
+    for container in containers(path):
+        if os.path.isfile(container):
+            return container in folders
+    return os.path.dirname(path) in folders or any(os.path.dirname(container) in folders
+                                                   for container in containers(path))
+
+
+def containers(path):
+    # Paths an email from an mbox or archive could have come from, e.g. "a#b.zip" and "a#b.zip#c.msg" for
+    # "a#b.zip#c.msg#d.msg" -- as the archive path and member name can contain "#" themselves
+    position = path.find("#")
+    while position != -1:
+        yield path[:position]
+        position = path.find("#", position + 1)
+
+
+def email_name(path):
+    # Name for log lines: the file name, or the archive (or mbox) name and the member e.g. "batch.zip#june/coverage.msg"
+    for container in containers(path):
+        if os.path.isfile(container):
+            return os.path.basename(container) + path[len(container):]
+    return os.path.basename(path)
+
+
+def background(items, maxsize):
+    # Run a generator in a thread, handing items over through a queue of at most maxsize
+    # The thread waits when the queue is full, so it never gets more than maxsize items ahead
+    items_queue = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        items_queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items_queue.put(done)
+        except BaseException as error:
+            items_queue.put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items_queue.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    # Also stops the thread if the consumer gives up early
+    finally:
+        stop.set()
+
+
+def extract_parallel(files, workers, log_queue=None, log_level=logging.DEBUG, executor=None):
+    # Yield (path, info, result) in input order, like the serial path
+    # Emails go to the pool in chunks, with at most two chunks per worker in flight -- so reading emails
+    # never runs far ahead of writing their articles
+    # A pool from make_pool() can be passed in to reuse it, otherwise one is started for these emails
+    if executor is None:
+        with make_pool(workers, log_queue, log_level) as executor:
+            yield from extract_parallel(files, workers, executor=executor)
+        return
+
+    pending = deque()
+    chunk = []
+    for item in files:
+        chunk.append(item)
+        if len(chunk) == CHUNK_SIZE:
+            pending.append(submit_chunk(executor, chunk))
+            chunk = []
+            if len(pending) >= workers * 2:
+                yield from collect_chunk(*pending.popleft())
+    if chunk:
+        pending.append(submit_chunk(executor, chunk))
+    while pending:
+        yield from collect_chunk(*pending.popleft())
+
+
+def make_pool(workers, log_queue=None, log_level=logging.DEBUG):
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                               initargs=(stats.enabled, log_queue, log_level))
+
+
+def submit_chunk(executor, chunk):
+    # Message bytes (from an mbox) go to the worker, only paths and info wait here for the results
+    future = executor.submit(extract_chunk, [(path, data) for path, _, data in chunk])
+    return [(path, info) for path, info, _ in chunk], future
+
+
+def extract_chunk(items):
+    return [extract_email(path, data=data) for path, data in items]
+
+
+def collect_chunk(chunk, future):
+    for (path, info), result in zip(chunk, future.result()):
+        yield path, info, result
+
+
+def init_worker(stats_enabled, log_queue, log_level):
+    # Worker processes don't share module state with the main process (on Windows), so pass it in
+    ignore_interrupts()
+    enable(stats_enabled)
+    worker_logging(log_queue, log_level)
+
+
+def ignore_interrupts():
+    # Ctrl+C reaches every process in the terminal's process group -- workers leave it to the main process,
+    # which stops sending them work and waits for what they're doing, rather than dying halfway through
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def extract_email(path, outlook=None, data=None):
+    # Open one email and return its articles (records.Article), along with timing info for the worker
+    # (and the stage timings when instrumentation is on, for the main process to merge)
+    # Articles are None if the email could not be read -- one damaged email doesn't stop the rest of the run
+    start = time.perf_counter()
+    stats.start_email(path)
+    try:
+        with stats.time("open"):
+            msg = open_email(outlook, path, data)
+        articles = parse_email(msg)
+    except Exception:
+        logging.exception(f"Could not read {email_name(path)}")
+        articles = None
+    snapshot = stats.take() if stats.enabled else None
+    return email_name(path), articles, time.perf_counter() - start, os.getpid(), snapshot
+
+
+def parse_email(msg):
+    # Find list items in the email body -- straight from the raw HTML stream when reading .msg files natively
+    with stats.time("body"):
+        if hasattr(msg, "raw_body"):
+            results = find_list_items(msg.raw_body, msg.codepage)
+        else:
+            results = find_list_items(msg.HTMLBody)
 
-    # Iterate through every email
-    for i, _ in enumerate(email_list):
+    articles = []
+    date = None
 
-        logging.info(email_list[i])
+    # Read attachment filenames once for all articles in this email
+    attachments = AttachmentIndex(msg)
 
-        # Create variable storing info from current email being parsed
-        msg = outlook.OpenSharedItem(os.path.join(folder_path, email_list[i]))
-        
-        # Search email HTML for body text
-        regex = re.search(r"<body([\s\S]*)</body>", msg.HTMLBody)
-        body = regex.group()
+    # For each unique entry detected by regex, retrieve title, publication, pubtype and links based on HTML
+    for header in results:
+        logging.debug(header)
         
-        # Search body text for unique entries, as indicated by <li> tag TODO (add or statement for regex)
-        # TRY li class=(MsoListParagraph|\"MsoListParagraph\")([\s\S]*?)</li> https://regex101.com/r/n530lx/1
-        pattern = r"li class=(MsoListParagraph|\"MsoListParagraph\")([\s\S]*?)</li>"
-        results = re.findall(pattern, body)
-        num_coverage = len(results)
+        # Get title, publication, platform, links from results
+        with stats.time("title_pub"):
+            title, publication, platform, links = get_title_pub(header)
 
-        # Check for alternate coding with quotes
-        if num_coverage == 0:
-            logging.warning(f"No coverage found in {email_list[i]}")
+        # Split string to parse variations in publication name e.g. HardwareZone vs HardwareZone Singapore
+        pubsplit = publication.split()
 
-        # Keep track of total amount of coverage
-        total_coverage += num_coverage
+        # Change date from "DD Month YY" to "dd/mm/yy"
+        try:
+            with stats.time("date"):
+                old_date_format = get_date(attachments, publication, pubsplit)
+            date = datetime.strptime(old_date_format, "%d %B %Y").strftime("%d/%m/%y")
 
-        logging.info(f"Processing email #{i + 1} out of {email_total}")
-        logging.info(f"Coverage: {num_coverage} articles\n")
+        # If no dates are found, revert to send date -- or leave the date blank if the email has none either
+        except TypeError:
+            stats.count("date_fallbacks")
+            if msg.SentOn is not None:
+                date = msg.SentOn.strftime("%d/%m/%y")
+            else:
+                logging.warning("Error: email has no send date, leaving the date blank")
+                date = None
 
-        # For each unique entry detected by regex, retrieve title, publication, pubtype and links based on HTML
-        for header in results:
-            logging.debug(header)
-            
-            # Get title, publication, platform, links from results
-            title, publication, platform, links = get_title_pub(header)
+        # In case of unknown date format
+        except ValueError:
+            pass
 
-            # Split string to parse variations in publication name e.g. HardwareZone vs HardwareZone Singapore
-            pubsplit = publication.split()
+        articles.append(Article(date, title, publication, platforms=platform, links=links))
 
-            # Change date from "DD Month YY" to "dd/mm/yy"
-            try:
-                old_date_format = get_date(msg, publication, pubsplit)
-                date = datetime.strptime(old_date_format, "%d %B %Y").strftime("%d/%m/%y")
+    return articles
 
-            # If no dates are found, revert to send date
-            except TypeError:
-                date = msg.SentOn.strftime("%d/%m/%y")
 
-            # In case of unknown date format
-            except ValueError:
-                pass
+# Unique entries in the body, as indicated by <li> tags (class name with or without quotes)
+# https://regex101.com/r/n530lx/1
+LIST_ITEM = re.compile(r"li class=(?:MsoListParagraph|\"MsoListParagraph\")([\s\S]*?)</li>")
+LIST_ITEM_BYTES = re.compile(LIST_ITEM.pattern.encode())
 
-            # Get tier and category
-            tier, category = get_tiercat(links, publication, pubsplit)
+# Codepages where bytes of a multi-byte character can look like ASCII, so spans can't be decoded on their own
+MULTIBYTE_CODEPAGES = {"cp932", "cp936", "cp949", "cp950"}
 
-            logging.debug(f"Title - {title}")
-            logging.debug(f"Pub - {publication}")
-            logging.debug(f"Platform - {platform}")
-            logging.debug(f"Link - {links}")
-            logging.debug(f"Tier - {tier}")
-            logging.debug(f"Category - {category}")
-            logging.debug(f"Date - {date}\n")
 
-            try:
-                db.execute("INSERT INTO articles (date, title, publication, tier, category) VALUES (?, ?, ?, ?, ?)",
-                           (date, title, publication, tier, category))
+def find_list_items(body, codepage=None):
+    # Return the inside of each list item between <body> and the last </body>, as strings
+    # body can be a str, or bytes in codepage -- then only the list items are decoded, not the whole body
+    if isinstance(body, bytes) and codepage in MULTIBYTE_CODEPAGES:
+        body = decode_html(body, codepage)
 
-            # Where two articles have the same title, differentiate the second title by adding "(2)"
-            except sqlite3.IntegrityError:
-                title = title + "(2)"
-                db.execute("INSERT INTO articles (date, title, publication, tier, category) VALUES (?, ?, ?, ?, ?)",
-                           (date, title, publication, tier, category))
+    if isinstance(body, bytes):
+        start, end = body.find(b"<body"), body.rfind(b"</body>")
+        pattern = LIST_ITEM_BYTES
+    else:
+        start, end = body.find("<body"), body.rfind("</body>")
+        pattern = LIST_ITEM
+    if start == -1 or end < start:
+        return []
 
-            # Copy id from main table into platforms and links table
-            db.execute("INSERT INTO platforms (article_id) SELECT id FROM articles WHERE title = ?", (title,))
-            db.execute("INSERT INTO links (article_id) SELECT id FROM articles WHERE title = ?", (title,))
+    # pos/endpos limit the search to the body without copying it
+    items = []
+    for match in pattern.finditer(body, start, end + len("</body>")):
+        item = match.group(1)
+        items.append(decode_html(item, codepage) if isinstance(item, bytes) else item)
+    return items
 
-            # Get article id and copy to platforms & links tables
-            article_id = db.execute("SELECT id FROM articles WHERE title = ?", (title,))
-            for item in article_id:
-                _id = item[0]
 
-            for i, _ in enumerate(platform):
-                db.execute(f"UPDATE platforms SET platform{i} = ? WHERE article_id = ?", (platform[i], _id))
+def write_batch(batch, sinks):
+    # Resolve tier & category, write the batch to every sink and record each email in processed_files
+    emails = []
+    for path, _, articles in batch:
+        stats.start_email(path)
+        emails.append((path, resolve_articles(articles, path)))
+    stats.start_email(None)
 
-            for i, _ in enumerate(links):
-                db.execute(f"UPDATE links SET link{i} = ? WHERE article_id = ?", (links[i], _id))
+    with stats.time("write"):
+        for sink in sinks:
+            sink.write(emails)
+
+        for path, (size, mtime, digest), _ in batch:
+            db.execute("INSERT INTO processed_files (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                       (path, size, mtime, digest))
+
+        tiercat_cache.flush()
+        db.commit()
+
+
+def get_file_info(path, data=None):
+    # Size, modified time and SHA-1 hash of the file content -- or of the message bytes, for emails from an mbox
+    if data is not None:
+        return len(data), None, hashlib.sha1(data).hexdigest()
+
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+def resolve_articles(articles, path=None):
+    # Fill in tier, category and source email of each article, in place, and return the articles
+
+    for article in articles:
+        article.file = path
+
+        # Get tier and category
+        pubsplit = article.publication.split()
+        with stats.time("tiercat"):
+            article.tier, article.category = get_tiercat(article.links, article.publication, pubsplit)
+
+        # Arguments are only formatted if debug logging is on
+        logging.debug("Title - %s", article.title)
+        logging.debug("Pub - %s", article.publication)
+        logging.debug("Platform - %s", article.platforms)
+        logging.debug("Link - %s", article.links)
+        logging.debug("Tier - %s", article.tier)
+        logging.debug("Category - %s", article.category)
+        logging.debug("Date - %s\n", article.date)
+
+    return articles
+
+
+def report_throughput(worker_stats):
+    for pid, (emails, articles, elapsed) in sorted(worker_stats.items()):
+        rate = emails / elapsed if elapsed else 0
+        logging.info(f"Worker {pid}: {emails} emails, {articles} articles in {elapsed:.2f}s ({rate:.1f} emails/s)")
 
-    db.commit()
 
-    logging.info(f"Total coverage: {total_coverage}")
+def open_email(outlook, path, data=None):
+    # Emails read out of an mbox or archive come with their bytes
+    if data is not None:
+        return read_msg(data) if path.lower().endswith(".msg") else read_eml(data)
+
+    # Internet mail (.eml and Maildir messages) is parsed with the email package
+    if not path.endswith(".msg"):
+        return open_eml(path)
+
+    # Use the built-in .msg reader unless an Outlook session was provided
+    if outlook is None:
+        return open_msg(path)
+    return outlook.OpenSharedItem(path)
+
+
+# Tokenizer for list items: tags and the text between them
+ITEM_TOKEN = re.compile(r"<([^>]*)>|([^<>]+)")
+PRINT = re.compile(r"\bPrint\b")
+PUB_TYPELIST = ["Online", "Facebook", "Instagram", "Twitter", "LinkedIn", "Linkedin", "Youtube"]
 
 
 def get_title_pub(header):
-    # Search HTML for title and publication, using regex to get text outside of <> and before )
-    header = str(header)
-    regex = re.search(r"[^<>]+(?=\(|sans-serif'>([\s\S]*?)</span>)", header)
+    # Walk the list item once, collecting the title/publication text, platforms, print mentions and links
+    title_pub = None
+    first_text = None
+    text = []
+    platform = []
+    prints = []
+    links = []
+    previous_text = None
+
+    # The item starts inside the opening <li ...> tag (after its class), so skip the rest of the tag's attributes
+    for match in ITEM_TOKEN.finditer(header, header.find(">") + 1):
+        tag, run = match.groups()
+
+        if run is not None:
+            text.append(run)
+
+            # Title and publication are the text before the last ( in the first run containing one
+            if title_pub is None:
+                bracket = run.rfind("(")
+                if bracket > 0:
+                    title_pub = run[:bracket]
+                elif first_text is None and run.strip():
+                    first_text = run
+
+            if "Print" in run:
+                prints.extend(PRINT.findall(run))
+
+            previous_text = run
+            continue
+
+        # Check 1: platform is the text just before a closing </a> tag
+        if tag is not None:
+            if tag.startswith("/a") and previous_text:
+                name = previous_text.rsplit('"', 1)[-1].strip()
+                if name:
+                    platform.append(html.unescape(name))
+
+            # Find all links
+            elif tag.startswith('a href="') and tag.endswith('"'):
+                links.append(tag[8:-1])
+
+        previous_text = None
+
+    # If there is no bracket, assume the whole first line of text is the title and publication
+    if title_pub is None:
+        title_pub = first_text or ""
 
     # HTML unescape to get rid of extant HTML like unicode dash '&8211;'
-    title_pub = html.unescape(regex.group())
+    title_pub = html.unescape(title_pub)
 
     # Create variable storing split strings
     _list = title_pub.split('–')
@@ -147,37 +726,20 @@ def get_title_pub(header):
         _list = title_pub.split('-')
         # If still cannot split, return error
         if len(_list) < 2:
-            logging.debug(f"\ntitle_pub = {title_pub}")
+            logging.debug("\ntitle_pub = %s", title_pub)
             logging.warning("Error: could not retrieve title/publication")
 
-    # Create empty list for pubtype variable
-    platform = []
-
-    # Check 1: Search for regular expression
-    regex = re.findall(r"[^\">]+(?=</a)", header)
-    if len(regex) > 0:
-        for match in regex:
-            match = html.unescape(match)
-            platform.append(match)
-
     # Check 2: compare strings in header against various pub platforms
-    pub_typelist = ["Online", "Facebook", "Instagram", "Twitter", "LinkedIn", "Linkedin", "Youtube"]
     if len(platform) == 0:
-        for pub in pub_typelist:
-            if pub in header:
+        text = "".join(text)
+        for pub in PUB_TYPELIST:
+            if pub in text:
                 platform.append(pub)
                 logging.debug("Match found!")
-                logging.debug(f"platform = {pub}")
+                logging.debug("platform = %s", pub)
 
     # Check for print publications
-    print_check = re.findall(r"\bPrint\b", header)
-    if print_check != None:
-        for i in print_check:
-            print_type = i
-            platform.append(print_type)
-
-    # Find all links using regex
-    links = re.findall(r"<a href=\"([\s\S]*?)\">", header)
+    platform.extend(prints)
 
     # Remove blank spaces in title and publication & record as variables
     try:
@@ -201,136 +763,174 @@ def get_title_pub(header):
         return title, publication, platform, links
 
 
-def get_date(msg, publication, pubsplit):
-    count_attachments = msg.Attachments.Count
+class AttachmentIndex:
+    # Attachment filenames of one email, read once and shared by every article in it
+    def __init__(self, msg):
+        self.count = msg.Attachments.Count
 
-    # Convert first 4 chars of send date into a string
-    year = str(msg.SentOn)[0:4]
+        # Convert first 4 chars of send date into a string (no year if the email has no send date)
+        year = str(msg.SentOn)[0:4] if msg.SentOn is not None else ""
 
-    # If there are attachments, iterate through each attachment and compare publication name against publication name in attachment filename
-    if count_attachments > 0:
-        for item in range(count_attachments):
+        # Case-folded filename and date taken from the filename e.g. "26 June - Tech4tea.pdf" -> "26 June 2020"
+        self.filenames = []
+        self.dates = []
+        for item in range(self.count):
             filename = msg.Attachments.Item(item + 1).Filename
-            if (re.search(f"^.*{publication}.*$", filename, flags=re.I) != None):
-                year = str(msg.SentOn)[0:4]
-                date = f"{filename.split('-')[0]}{year}"
-                return date
+            self.filenames.append(filename.casefold())
+            self.dates.append(f"{filename.split('-')[0]}{year}")
 
-        # If loop completes and no exact match found, look for alternative
+        # Bitmask of attachments containing each word that has been looked up
+        self.masks = {}
+
+    def find(self, word):
+        word = word.casefold()
+        mask = self.masks.get(word)
+        if mask is None:
+            mask = 0
+            for item, filename in enumerate(self.filenames):
+                if word in filename:
+                    mask |= 1 << item
+            self.masks[word] = mask
+        return mask
+
+    def get_date(self, mask):
+        # Date of the first attachment in the mask
+        return self.dates[(mask & -mask).bit_length() - 1]
+
+
+def get_date(attachments, publication, pubsplit):
+
+    # If there are attachments, compare publication name against publication name in attachment filename
+    if attachments.count > 0:
+        mask = attachments.find(publication)
+        if mask:
+            return attachments.get_date(mask)
+
+        # If no exact match found, look for alternative
         logging.debug("No exact match found -- looking for alternative match")
-        for item in range(count_attachments):
+        mask = 0
+        for i in range(len(pubsplit) - 1):
+            first = attachments.find(pubsplit[i])
 
-            # Retrieve filename of attachment
-            filename = msg.Attachments.Item(item + 1).Filename
+            # Check if filename matches first and second word in publication name
+            mask |= first & attachments.find(pubsplit[i + 1])
 
-            for i in range(len(pubsplit) - 1):
-                # Check if filename matches first word in publication name
-                logging.debug(f"Checking for '{pubsplit[i]}' in {filename} . . .", end=" ")
-                if (re.search(f"^.*{pubsplit[i]}.*$", filename, flags=re.I) != None):
-                    if len(pubsplit) == 1:
-                        date = f"{filename.split('-')[0]}{year}"
-                        print("Match found!")
-                        return date
-
-                    logging.debug(f"Checking for '{pubsplit[i+1]}' in {filename} . . .", end=" ")
-                    # Check if filename matches second word in publication name
-                    if (re.search(f"^.*{pubsplit[i+1]}.*$", filename, flags=re.I) != None):
-
-                        # Return date if two matches found
-                        logging.debug("Match found!")
-                        date = f"{filename.split('-')[0]}{year}"
-                        return date
-
-                # If both checks fail, check for matches of first word without special chars
-                else:
-                    regex = re.compile('[^a-zA-Z]')
-                    new_string = regex.sub("", pubsplit[i])
-                    if (re.search(f"^.*{new_string}.*$", filename, flags=re.I) != None):
-                        date = f"{filename.split('-')[0]}{year}"
-                        return date
-        
+            # If first word doesn't match, check for matches of first word without special chars
+            new_string = re.sub('[^a-zA-Z]', "", pubsplit[i])
+            mask |= ~first & attachments.find(new_string)
+
+        if mask:
+            return attachments.get_date(mask)
 
+        # No date -- parse_email falls back to the send date (and counts the fallback)
         logging.warning("Error: could not retrieve date from attachment, reverting to send date")
-        date = str(msg.SentOn)[0:9]
-        return date
+        return None
 
 
 def get_tiercat(links, publication, pubsplit):
-    database = db.execute("SELECT * FROM medialist")
-
-    # Get maximum rows
-    count = db.execute("SELECT COUNT(*) FROM medialist")
-    for result in count:
-        max_rows = result[0]
-
-    # Remove spaces from publication name
-    string = publication.replace(" ", "")
-
-    # Create variable to keep track of rows
-    row_counter = 0
-
-    for row in database:
-        row_counter += 1
-        url = row[0]
-
-        # Create a variable that stores the initial part of the link e.g. www.hardwarezone.com.sg
-        regex = re.search(r"(?<=//)(.*?)(?=\/)", links[0])
-        link = regex.group()
-
-        # Check 1: Compares the database URL and the link URL with each other - if match found, return tier and media type
-        if link.find(f"{url}") != -1 or url.find(f"{link}") != -1:
-            tier = row[1]
-            category = row[2]
-            return tier, category
-
-        # Check 2: Compare publication name and truncated version of publication name against database
-        if row_counter == max_rows:
-            database = db.execute("SELECT * FROM medialist")
-            row_counter = 0
-
-            for row in database:
-                row_counter += 1
-                url1 = row[0]
-                url2 = row[0].replace(" ", "")
-                logging.debug(f"Checking for {string} against {url1}")
-                if re.search(f"{string}", url1, flags=re.I) != None or re.search(f"{string}", url2, flags=re.I) != None:
-                    tier = row[1]
-                    category = row[2]
-                    return tier, category
-
-        # Check 3: take the first word of the publication name from email and compare against database
-        if row_counter == max_rows:
-            database = db.execute("SELECT * FROM medialist")
-            row_counter = 0
-
-            for row in database:
-                row_counter += 1
-                url1 = row[0]
-                logging.debug(f"Checking for '{pubsplit[0]}' in {url1} . . .")
-                if (re.search(f"{pubsplit[0]}", url1, flags=re.I) != None):
-                    tier = row[1]
-                    category = row[2]
-                    return tier, category
-
-        # Check 4: take the first word of the publication name from email, remove non-alphanumeric chars then compare against database
-        if row_counter == max_rows:
-            database = db.execute("SELECT * FROM medialist")
-            row_counter = 0
-
-            regex = re.compile('[^a-zA-Z]')
-            new_string = regex.sub("", pubsplit[0])
-            if new_string != "":
-                for row in database:
-                    row_counter += 1
-                    url1 = row[0]
-                    logging.debug(f"Checking for '{new_string}' in {url1} . . .")
-                    if (re.search(f"{new_string}", url1, flags=re.I) != None):
-                        tier = row[1]
-                        category = row[2]
-                        return tier, category
-
-    logging.warning("Tier/Type not found")
-    tier = category = ("N/A")
+    # Look up earlier results for the same link host and publication name first (when run from main)
+    if tiercat_cache is not None:
+        host, path = split_url(links[0]) if links else ("", "")
+        key = (media_index.cache_key(host, path) if host else "", name_key(publication))
+        result = tiercat_cache.get(key)
+        if result is None:
+            stats.count("tiercat_cache_misses")
+            result = resolve_tiercat(host, path, publication)
+            tiercat_cache.put(key, result)
+        else:
+            stats.count("tiercat_cache_hits")
+    else:
+        result = resolve_tiercat(*(split_url(links[0]) if links else ("", "")), publication)
+
+    tier, category, source = result
+    stats.count(TIERCAT_COUNTERS[source])
+    if source == "none":
+        logging.warning("Tier/Type not found")
     return tier, category
 
-main()
\ No newline at end of file
+
+# Counter for each check in resolve_tiercat
+TIERCAT_COUNTERS = {"link": "tiercat_link_matches", "name": "tiercat_name_matches", "none": "tiercat_not_found"}
+
+
+def resolve_tiercat(host, path, publication):
+    # Return tier, category and which check matched, given the host and path of the first link
+    # Check 1: Look up the host (and path) of the first link in the medialist index - if match found, return tier and media type
+    if host:
+        result = media_index.lookup_host(host, path)
+        if result is not None:
+            return result + ("link",)
+
+    # Checks 2-4: look for medialist outlet names at the start of the publication name, preferring the longest
+    result = name_matcher.lookup(publication)
+    if result is not None:
+        return result + ("name",)
+
+    tier = category = ("N/A")
+    return tier, category, "none"
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Parse coverage emails (.msg, .eml, Maildir, mbox, zip/tar archives) "
+                                                 "into a database and Excel report")
+    parser.add_argument("inputs", nargs="*",
+                        help=".msg/.eml files, folders, Maildirs, mbox files, zip/tar archives or globs, "
+                             "or - to read a list of files from stdin "
+                             "(default: choose a folder in a dialog box)")
+    parser.add_argument("--db", default="emails.db", help="SQLite database path (default: emails.db)")
+    parser.add_argument("--medialist", default="medialist.csv", help="media list CSV (default: medialist.csv)")
+    parser.add_argument("--xlsx", help="write an Excel report to this path when done")
+    parser.add_argument("--open", action="store_true", help="open the Excel report when done")
+    parser.add_argument("--output", action="append", default=[],
+                        help="extra output file (.jsonl, .csv or .parquet), can be repeated")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes (default: 1)")
+    parser.add_argument("--batch-size", type=int, default=100, help="articles per database commit (default: 100)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only parse new or changed emails (also resumes an interrupted run)")
+    parser.add_argument("--outlook", action="store_true", help="open emails through Outlook (Windows only)")
+    parser.add_argument("--stats", help="write per-stage timings and counters to this JSON file")
+    parser.add_argument("--prometheus", help="write the same metrics in Prometheus text format to this file")
+    parser.add_argument("--duplicates", default="suffix", choices=DUPLICATE_POLICIES,
+                        help="repeated articles: add (2) to the title, merge their links or skip them (default: suffix)")
+    levels = ["DEBUG", "INFO", "WARNING", "ERROR"]
+    parser.add_argument("--log-level", default="DEBUG", choices=levels, help="console log level (default: DEBUG)")
+    parser.add_argument("--file-log-level", default="DEBUG", choices=levels, help="log.txt log level (default: DEBUG)")
+    parser.add_argument("--log-file", default="log.txt", help="log file path, or an empty string for none")
+    parser.add_argument("--sync-logging", action="store_true", help="write log lines from the parse loop itself")
+    parser.add_argument("--progress", type=float, metavar="SECONDS",
+                        help="log a progress summary at most every SECONDS instead of per-email lines")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and parse emails as they land in the given folders (stop with Ctrl+C)")
+    parser.add_argument("--settle", type=float, default=0.5, metavar="SECONDS",
+                        help="with --watch, wait until a file hasn't changed for SECONDS before parsing it "
+                             "(default: 0.5)")
+    parser.add_argument("--poll", type=float, default=1.0, metavar="SECONDS",
+                        help="with --watch, how often to scan the folders where inotify isn't available (default: 1)")
+    parser.add_argument("--rebuild-every", type=float, default=60.0, metavar="SECONDS",
+                        help="with --watch and --xlsx, rebuild the report at most every SECONDS (default: 60)")
+    args = parser.parse_args(argv)
+
+    # Watch mode keeps the database & medialist loaded and rebuilds the report itself as articles come in
+    if args.watch:
+        import watch
+        watch.watch(args.inputs or [ask_folder()], args.db, args.medialist, workers=args.workers,
+                    batch_size=args.batch_size, outputs=args.output, xlsx_path=args.xlsx,
+                    rebuild_every=args.rebuild_every, settle=args.settle, poll_interval=args.poll,
+                    stats_path=args.stats, prometheus_path=args.prometheus, console_level=args.log_level,
+                    file_level=args.file_log_level, log_path=args.log_file, duplicates=args.duplicates)
+        return
+
+    main(args.inputs or None, args.db, args.medialist, use_outlook=args.outlook, workers=args.workers,
+         batch_size=args.batch_size, incremental=args.incremental, outputs=args.output,
+         stats_path=args.stats, prometheus_path=args.prometheus, console_level=args.log_level,
+         file_level=args.file_log_level, log_path=args.log_file, log_background=not args.sync_logging,
+         progress_interval=args.progress, duplicates=args.duplicates)
+
+    # xlsxwriter is only needed for the report
+    if args.xlsx:
+        import excel
+        excel.export(args.db, args.xlsx, open_when_done=args.open)
+
+
+if __name__ == "__main__":
+    cli()
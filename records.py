@@ -0,0 +1,78 @@
+from operator import attrgetter
+
+# Article records passed between the parser, the sinks and the Excel writer
+
+FIELDS = ("date", "title", "publication", "tier", "category", "platforms", "links", "file")
+
+
+class Article:
+    # One article -- __slots__ keeps instances as small as a tuple, without a __dict__ each
+    # Tier, category and file are filled in by the main process once the article comes back from the parser
+    __slots__ = FIELDS
+
+    def __init__(self, date, title, publication, tier=None, category=None, platforms=(), links=(), file=None):
+        self.date = date
+        self.title = title
+        self.publication = publication
+        self.tier = tier
+        self.category = category
+        self.platforms = platforms
+        self.links = links
+        self.file = file
+
+    def __iter__(self):
+        # Fields in FIELDS order, so an article can still be unpacked like the tuples it replaces
+        return iter((self.date, self.title, self.publication, self.tier, self.category, self.platforms, self.links,
+                     self.file))
+
+    def __eq__(self, other):
+        if not isinstance(other, Article):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    # Articles are changed in place (tier, category and file are filled in later) and hold platforms & links as
+    # lists, so they can't be hashed -- the tuples they replace couldn't be either, with lists inside
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Article({', '.join(f'{field}={value!r}' for field, value in zip(FIELDS, self))})"
+
+    def __reduce__(self):
+        # Pickle as the constructor arguments (e.g. from worker processes), rather than a dict of slot names
+        return Article, tuple(self)
+
+    def as_dict(self):
+        return dict(zip(FIELDS, self))
+
+
+# attrgetter per field, to read a whole column of articles in C rather than one attribute at a time in Python
+GETTERS = tuple(attrgetter(field) for field in FIELDS)
+
+
+class ArticleBatch:
+    # Articles stored column by column -- one list per field, in FIELDS order
+    def __init__(self, articles=()):
+        self.columns = tuple([] for _ in FIELDS)
+        self.extend(articles)
+
+    def extend(self, articles):
+        articles = articles if isinstance(articles, list) else list(articles)
+        for column, getter in zip(self.columns, GETTERS):
+            column.extend(map(getter, articles))
+
+    def take(self, count):
+        # Remove the first count articles and return them as a new batch
+        batch = ArticleBatch()
+        for column, taken in zip(self.columns, batch.columns):
+            taken.extend(column[:count])
+            del column[:count]
+        return batch
+
+    def column(self, field):
+        return self.columns[FIELDS.index(field)]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return (Article(*values) for values in zip(*self.columns))
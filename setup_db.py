@@ -1,9 +1,11 @@
 import sqlite3
 import csv
+import hashlib
+import io
 
-def setup():
+def setup(incremental=False, db_path="emails.db", medialist_path="medialist.csv"):
     # Create & connect to database
-    db = sqlite3.connect("emails.db")
+    db = sqlite3.connect(db_path)
 
     # Create tables for email parser to fill
     db.execute("""
@@ -14,64 +16,229 @@ def setup():
 	"publication"	TEXT,
 	"tier"	INTEGER,
 	"category"	TEXT,
+	"file"	TEXT,
+	"dedup_key"	TEXT,
 	PRIMARY KEY("id" AUTOINCREMENT))
     """)
 
+    # Add source file column to databases created before incremental mode
+    columns = [row[1] for row in db.execute("PRAGMA table_info(articles)")]
+    if "file" not in columns:
+        db.execute('ALTER TABLE articles ADD COLUMN "file" TEXT')
+
+    # Hash of normalized title, publication and first link, to spot repeated articles (see sinks.dedup_key)
+    if "dedup_key" not in columns:
+        db.execute('ALTER TABLE articles ADD COLUMN "dedup_key" TEXT')
+    db.execute('CREATE INDEX IF NOT EXISTS "articles_dedup_key" ON "articles" ("dedup_key")')
+
+    # Articles are looked up by email when re-parsing it
+    db.execute('CREATE INDEX IF NOT EXISTS "articles_file" ON "articles" ("file")')
+
+    # One row per link of an article, with the platform it was published on
     db.execute("""
-    CREATE TABLE IF NOT EXISTS "links" (
+    CREATE TABLE IF NOT EXISTS "article_links" (
 	"article_id"	INTEGER,
-	"link0"	TEXT,
-	"link1"	TEXT,
-	"link2"	TEXT,
-	"link3"	TEXT,
-	"link4"	TEXT,
-	PRIMARY KEY("article_id"))
+	"position"	INTEGER,
+	"platform"	TEXT,
+	"url"	TEXT,
+	PRIMARY KEY("article_id", "position"))
     """)
 
+    # Every email an article was found in -- a repeated article is a single row in articles (see sinks.SQLiteSink),
+    # so it is only removed once all the emails it came from are gone
+    found = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'article_sources'").fetchone()
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS "article_sources" (
+	"article_id"	INTEGER,
+	"file"	TEXT,
+	PRIMARY KEY("article_id", "file"))
+    """)
+    db.execute('CREATE INDEX IF NOT EXISTS "article_sources_file" ON "article_sources" ("file")')
+
+    # Articles saved before the table existed came from the email in their file column
+    if not found:
+        db.execute("INSERT INTO article_sources (article_id, file) SELECT id, file FROM articles WHERE file IS NOT NULL")
+
     db.execute("""
     CREATE TABLE IF NOT EXISTS "medialist" (
 	"url"	TEXT UNIQUE,
 	"tier"	INTEGER,
-	"type"	TEXT)
+	"type"	TEXT,
+	"position"	INTEGER)
     """)
 
+    # Add row order column to databases created before the medialist loader (earlier rows win in lookups)
+    columns = [row[1] for row in db.execute("PRAGMA table_info(medialist)")]
+    if "position" not in columns:
+        db.execute('ALTER TABLE medialist ADD COLUMN "position" INTEGER')
+
+    # Move data from the old fixed-width links/platforms tables, then replace them with views for excel.py
+    migrate_links(db, "links", "url")
+    migrate_links(db, "platforms", "platform")
+    create_view(db, "links", "url", "link")
+    create_view(db, "platforms", "platform", "platform")
+
+    # Manifest of parsed emails, used to skip unchanged files in incremental mode
     db.execute("""
-    CREATE TABLE IF NOT EXISTS "platforms" (
-	"article_id"	INTEGER,
-	"platform0"	TEXT,
-	"platform1"	TEXT,
-	"platform2"	TEXT,
-	"platform3"	TEXT,
-	"platform4"	TEXT,
-	PRIMARY KEY("article_id"))
+    CREATE TABLE IF NOT EXISTS "processed_files" (
+	"path"	TEXT,
+	"size"	INTEGER,
+	"mtime"	REAL,
+	"hash"	TEXT,
+	PRIMARY KEY("path"))
     """)
 
-    # Write files
-    results = db.execute("""SELECT * FROM medialist """)
-    if not [r for r in results]:
+    # Tier & category resolved per link host and publication name (see medialist.TierCache)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS "tiercat_cache" (
+	"host"	TEXT,
+	"publication"	TEXT,
+	"tier"	INTEGER,
+	"category"	TEXT,
+	"source"	TEXT,
+	PRIMARY KEY("host", "publication"))
+    """)
+
+    # Settings that should survive between runs, e.g. the medialist hash the cache was built from
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS "metadata" (
+	"key"	TEXT,
+	"value"	TEXT,
+	PRIMARY KEY("key"))
+    """)
+
+    # Load medialist.csv into the medialist table if it changed since the last run
+    load_medialist(db, medialist_path)
+    db.commit()
+
+    # Reset databases after each run, unless only changed files are being parsed
+    if not incremental:
+        db.execute("DELETE FROM articles")
+        db.execute("DELETE FROM article_links")
+        db.execute("DELETE FROM article_sources")
+        db.execute("DELETE FROM processed_files")
+
+    return db
+
+
+def load_medialist(db, medialist_path):
+    # Skip the CSV if it has the same content as the last time it was loaded
+    try:
+        with open(medialist_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        if db.execute("SELECT 1 FROM medialist LIMIT 1").fetchone():
+            print(f"{medialist_path} not found, using the medialist table as is")
+            return
         print("Error: 'medialist' table is empty!")
-        print("Attempting to write medialist.csv to database")
+        print(f"{medialist_path} not found")
+        exit(1)
+
+    digest = hashlib.sha1(data).hexdigest()
+    stored = db.execute("SELECT value FROM metadata WHERE key = 'medialist_csv'").fetchone()
+    if stored and stored[0] == digest:
+        return
+
+    # Read the CSV in file order -- where a URL is listed twice, the first row counts
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("cp1252", errors="replace")
+    reader = csv.reader(io.StringIO(text))
+    header = [name.strip() for name in next(reader, [])]
+    columns = [header.index(name) for name in ("url", "tier", "type")]
+    width = max(columns) + 1
+    url_column, tier_column, type_column = columns
+
+    rows = {}
+    for record in reader:
+        if len(record) < width:
+            continue
+        url = normalize_url(record[url_column])
+        if url and url not in rows:
+            rows[url] = (record[tier_column].strip(), record[type_column].strip(), len(rows))
+
+    # Compare with the table to find what changed, and only write those rows
+    existing = {url: (str(tier), category, position)
+                for url, tier, category, position in db.execute("SELECT url, tier, type, position FROM medialist")}
+    added = []
+    changed = []
+    updates = []
+    for url, row in rows.items():
+        old = existing.get(url)
+        if old is None:
+            added.append(url)
+        elif old[:2] != row[:2]:
+            changed.append(url)
+        elif old[2] == row[2]:
+            continue
+        updates.append((url,) + row)
+    removed = [url for url in existing if url not in rows]
+
+    # One transaction: upsert new, changed and moved rows (positions follow the file), then drop outlets no longer listed
+    with db:
+        db.executemany("""INSERT INTO medialist (url, tier, type, position) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (url) DO UPDATE SET tier = excluded.tier, type = excluded.type,
+                       position = excluded.position""", updates)
+        db.executemany("DELETE FROM medialist WHERE url = ?", [(url,) for url in removed])
+        db.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('medialist_csv', ?)", (digest,))
 
-        # Open new CSV file for writing
-        try:
-            with open("medialist.csv", "r") as medialist:
-                reader = csv.DictReader(medialist)
-                for row in reader:
-                    print(row)
-                    db.execute("INSERT INTO medialist (url, tier, type) VALUES(?, ?, ?)",
-                                (row["url"], row["tier"], row["type"]))
+    print(f"Loaded {medialist_path}: {len(rows)} outlets, {len(added)} added, {len(changed)} changed, "
+          f"{len(removed)} removed")
+    for label, urls in [("Added", added), ("Changed", changed), ("Removed", removed)]:
+        for url in urls[:MEDIALIST_REPORT_LIMIT]:
+            print(f"  {label}: {url}")
+        if len(urls) > MEDIALIST_REPORT_LIMIT:
+            print(f"  ... and {len(urls) - MEDIALIST_REPORT_LIMIT} more")
 
-        except FileNotFoundError:
-            print("medialist.csv not found")
-            exit(1)
 
+# Outlets listed per kind of change when loading the medialist
+MEDIALIST_REPORT_LIMIT = 20
+
+
+def normalize_url(url):
+    # Trim spaces, lowercase the host and drop any scheme, "www." or trailing slash
+    # e.g. " Bloomberg.com/live/asia " -> "bloomberg.com/live/asia"
+    url = url.strip()
+
+    # Most URLs are already written this way
+    if url.islower() and "//" not in url and not url.startswith("www.") and not url.endswith("/"):
+        return url
+
+    if "//" in url:
+        url = url.split("//", 1)[1]
+    host, slash, path = url.partition("/")
+    host = host.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return (host + slash + path).rstrip("/")
+
+
+def migrate_links(db, table, column):
+    found = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if not found:
+        return
+
+    for row in db.execute(f"SELECT * FROM {table}").fetchall():
+        for position, value in enumerate(row[1:]):
+            if value is not None:
+                db.execute(f"""INSERT INTO article_links (article_id, position, {column}) VALUES (?, ?, ?)
+                           ON CONFLICT (article_id, position) DO UPDATE SET {column} = excluded.{column}""",
+                           (row[0], position, value))
+
+    db.execute(f"DROP TABLE {table}")
     db.commit()
 
-    # Reset databases after each run
-    db.execute("DELETE FROM articles")
-    db.execute("DELETE FROM platforms")
-    db.execute("DELETE FROM links")
 
-    return db
+def create_view(db, name, column, prefix, width=5):
+    # Fixed-width view over article_links e.g. links(article_id, link0 ... link4), one row per article in id order
+    columns = ", ".join(f"MAX(CASE WHEN l.position = {i} THEN l.{column} END) AS {prefix}{i}" for i in range(width))
+    db.execute(f"""
+    CREATE VIEW IF NOT EXISTS "{name}" AS
+    SELECT a.id AS article_id, {columns}
+    FROM articles a LEFT JOIN article_links l ON l.article_id = a.id
+    GROUP BY a.id ORDER BY a.id
+    """)
 
-setup()
\ No newline at end of file
+if __name__ == "__main__":
+    setup()
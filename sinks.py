@@ -0,0 +1,247 @@
+import csv
+import hashlib
+import json
+import os
+from itertools import zip_longest
+from urllib.parse import urlsplit
+
+from instrument import stats
+from records import ArticleBatch, FIELDS
+
+# Output sinks for parsed articles -- the parse loop writes each batch to every sink in one pass
+# A batch is a list of (path, articles) for each email, where each article is a records.Article
+
+
+class SQLiteSink:
+    # Writes to the articles & article_links tables (emails.db), replacing articles from re-parsed emails
+    # Repeated articles (same title, publication and first link, see dedup_key) are handled by the duplicates policy:
+    #   "suffix" - keep both, adding "(2)", "(3)" ... to the title of the repeat
+    #   "merge" - add the repeat's links to the first article
+    #   "skip" - keep the first article only
+    # Other articles with a title that's already taken get the same suffix, as titles are unique in the table
+    # Every email an article was found in is kept in article_sources, so a merged or skipped repeat still counts
+    # towards the first article -- see forget()
+    def __init__(self, db, duplicates="suffix"):
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicates policy: {duplicates}")
+        self.db = db
+        self.duplicates = duplicates
+        self.link_rows = []
+        self.source_rows = []
+
+        # In-memory index of articles already in the table: dedup key -> article id, and every title in use
+        self.keys = {}
+        self.titles = set()
+        self.suffixes = {}
+
+        # Articles saved before the dedup_key column existed get their key now
+        missing = []
+        for article_id, title, publication, key, link in db.execute("""
+                SELECT a.id, a.title, a.publication, a.dedup_key, l.url
+                FROM articles a LEFT JOIN article_links l ON l.article_id = a.id AND l.position = 0"""):
+            self.titles.add(title)
+            if key is None:
+                key = dedup_key(title, publication, [link])
+                missing.append((key, article_id))
+            self.keys.setdefault(key, article_id)
+        db.executemany("UPDATE articles SET dedup_key = ? WHERE id = ?", missing)
+
+    def write(self, batch):
+        for path, articles in batch:
+            self.forget(path)
+            self.write_articles(articles)
+        self.flush_links()
+
+    def write_articles(self, articles):
+        for article in articles:
+            title = article.title
+            publication = article.publication
+            platform = article.platforms
+            links = article.links
+
+            # One lookup decides whether this article was seen before
+            key = dedup_key(title, publication, links)
+            first = self.keys.get(key)
+            if first is not None:
+                stats.count("duplicate_articles")
+                if self.duplicates == "skip":
+                    self.source_rows.append((first, article.file))
+                    continue
+                if self.duplicates == "merge":
+                    self.merge_links(first, platform, links)
+                    self.source_rows.append((first, article.file))
+                    continue
+
+            # Where two articles have the same title, differentiate the later title by adding "(2)", "(3)" ...
+            if title in self.titles:
+                stats.count("duplicate_titles")
+                title = self.unique_title(title)
+
+            cursor = self.db.execute("INSERT INTO articles (date, title, publication, tier, category, file, dedup_key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (article.date, title, publication, article.tier, article.category, article.file,
+                                      key))
+            self.titles.add(title)
+            self.keys.setdefault(key, cursor.lastrowid)
+            self.source_rows.append((cursor.lastrowid, article.file))
+
+            # Pair up platforms and links by position, using the new article id
+            for position, (platform_name, url) in enumerate(zip_longest(platform, links)):
+                self.link_rows.append((cursor.lastrowid, position, platform_name, url))
+
+    def unique_title(self, title):
+        number = self.suffixes.get(title, 2)
+        while f"{title}({number})" in self.titles:
+            number += 1
+        self.suffixes[title] = number + 1
+        return f"{title}({number})"
+
+    def merge_links(self, article_id, platform, links):
+        # Add links (and their platforms) that the first article doesn't have yet, after its own links
+        self.flush_links()
+        known = {canonical_link(url) for url, in self.db.execute("SELECT url FROM article_links WHERE article_id = ?",
+                                                                 (article_id,)) if url}
+        position = self.db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM article_links WHERE article_id = ?",
+                                   (article_id,)).fetchone()[0]
+        for platform_name, url in zip_longest(platform, links):
+            if url is not None and canonical_link(url) not in known:
+                self.link_rows.append((article_id, position, platform_name, url))
+                known.add(canonical_link(url))
+                position += 1
+
+    def flush_links(self):
+        # Links and sources of the articles written so far (an email can list the same article twice, hence IGNORE)
+        self.db.executemany("INSERT INTO article_links (article_id, position, platform, url) VALUES (?, ?, ?, ?)",
+                            self.link_rows)
+        self.db.executemany("INSERT OR IGNORE INTO article_sources (article_id, file) VALUES (?, ?)",
+                            self.source_rows)
+        self.link_rows = []
+        self.source_rows = []
+
+    def forget(self, path):
+        # Remove a re-parsed or deleted email's articles from the tables and the index, and the email from
+        # processed_files -- articles that other emails have too are kept, moved to one of those emails
+        if self.link_rows or self.source_rows:
+            self.flush_links()
+
+        for article_id, title, key, file in self.db.execute("""
+                SELECT a.id, a.title, a.dedup_key, a.file
+                FROM article_sources s JOIN articles a ON a.id = s.article_id WHERE s.file = ?""", (path,)).fetchall():
+            self.db.execute("DELETE FROM article_sources WHERE article_id = ? AND file = ?", (article_id, path))
+            other = self.db.execute("SELECT file FROM article_sources WHERE article_id = ? ORDER BY rowid LIMIT 1",
+                                    (article_id,)).fetchone()
+            if other is not None:
+                if file == path:
+                    self.db.execute("UPDATE articles SET file = ? WHERE id = ?", (other[0], article_id))
+                continue
+
+            self.titles.discard(title)
+            if self.keys.get(key) == article_id:
+                del self.keys[key]
+            self.db.execute("DELETE FROM article_links WHERE article_id = ?", (article_id,))
+            self.db.execute("DELETE FROM articles WHERE id = ?", (article_id,))
+
+        self.db.execute("DELETE FROM processed_files WHERE path = ?", (path,))
+
+    def close(self):
+        self.db.commit()
+
+
+DUPLICATE_POLICIES = ("suffix", "merge", "skip")
+
+
+def dedup_key(title, publication, links):
+    # Hash of the case-folded title & publication and the first link without scheme, "www.", fragment or trailing slash
+    link = canonical_link(links[0]) if links and links[0] else ""
+    parts = (" ".join(title.casefold().split()), " ".join(publication.casefold().split()), link)
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def canonical_link(url):
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host + parts.path.rstrip("/") + (f"?{parts.query}" if parts.query else "")
+
+
+class JSONLSink:
+    # One JSON object per line
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, batch):
+        lines = [json.dumps(article.as_dict(), ensure_ascii=False) + "\n"
+                 for _, articles in batch for article in articles]
+        self.file.writelines(lines)
+
+    def close(self):
+        self.file.close()
+
+
+class CSVSink:
+    # Platforms and links are joined with " | " as CSV has no list type
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(FIELDS)
+
+    def write(self, batch):
+        self.writer.writerows(
+            (a.date, a.title, a.publication, a.tier, a.category, " | ".join(a.platforms), " | ".join(a.links), a.file)
+            for _, articles in batch for a in articles)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    # Buffers articles column by column into row groups of row_group_size (requires pyarrow)
+    def __init__(self, path, row_group_size=10000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ("date", pa.string()), ("title", pa.string()), ("publication", pa.string()),
+            ("tier", pa.string()), ("category", pa.string()),
+            ("platforms", pa.list_(pa.string())), ("links", pa.list_(pa.string())), ("file", pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.articles = ArticleBatch()
+
+    def write(self, batch):
+        for _, articles in batch:
+            self.articles.extend(articles)
+        while len(self.articles) >= self.row_group_size:
+            self.flush(self.articles.take(self.row_group_size))
+
+    def flush(self, articles):
+        # Tier is an int from the medialist or "N/A", so store it as text
+        columns = list(articles.columns)
+        columns[3] = [None if tier is None else str(tier) for tier in columns[3]]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        if len(self.articles):
+            self.flush(self.articles)
+            self.articles = ArticleBatch()
+        self.writer.close()
+
+
+def open_sink(path):
+    # Pick a sink from the output file extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return JSONLSink(path)
+    if extension == ".csv":
+        return CSVSink(path)
+    if extension == ".parquet":
+        return ParquetSink(path)
+    raise ValueError(f"Unknown output format: {path}")
+
@@ -0,0 +1,366 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import outlook
+from archive_reader import is_archive
+from mail_reader import is_maildir
+
+# Watch mode: a long-running parser that keeps the database, medialist indexes and sinks open between emails,
+# and parses each email as it lands in the watched folders
+# New files are spotted with inotify on Linux, or by scanning the folders every poll interval elsewhere
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event: watch descriptor, mask, cookie and name length, followed by the name
+EVENT = struct.Struct("iIII")
+
+# How often pending files are checked to see if they're done being written
+CHECK_INTERVAL = 0.1
+
+
+def watch(folders, db_path="emails.db", medialist_path="medialist.csv", workers=1, batch_size=100, outputs=(),
+          xlsx_path=None, rebuild_every=60.0, settle=0.5, poll_interval=1.0, stats_path=None, prometheus_path=None,
+          console_level="INFO", file_level="DEBUG", log_path="log.txt", duplicates="suffix", stop=None):
+    # Parse emails already in the folders, then keep parsing new and changed ones until interrupted (or stop is set)
+    # A file is parsed once its size and modified time have stayed the same for settle seconds,
+    # so emails that are still being copied in aren't read half-written
+    run_start = time.perf_counter()
+    stop = stop or threading.Event()
+    folders = [os.path.abspath(folder) for folder in folders]
+
+    # Everything that stays warm between emails -- database, medialist indexes, sinks, logging and worker processes
+    sinks, log_setup, _ = outlook.start(db_path, medialist_path, incremental=True, outputs=outputs,
+                                        stats_enabled=bool(stats_path or prometheus_path),
+                                        console_level=console_level, file_level=file_level, log_path=log_path,
+                                        duplicates=duplicates)
+    executor = None
+    if workers > 1:
+        executor = outlook.make_pool(workers, log_setup.worker_queue(), log_setup.root.level)
+    rebuilder = WorkbookRebuilder(db_path, xlsx_path, rebuild_every) if xlsx_path else None
+    totals = outlook.Totals()
+
+    def ingest(inputs, known):
+        outlook.ingest(inputs, totals, sinks, workers=workers, batch_size=batch_size, known=known,
+                       log_setup=log_setup, executor=executor)
+
+    # Stop cleanly on SIGTERM as well as Ctrl+C (signal handlers can only be set from the main thread)
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    # Start watching before the first scan, so emails landing during the scan aren't missed
+    watcher = open_watcher(watched_folders(folders), poll_interval)
+    settler = Settler(settle)
+    try:
+        ingest(folders, outlook.load_known())
+        logging.info(f"Watching {', '.join(folders)} ({type(watcher).__name__})")
+        if rebuilder:
+            rebuilder.update(changed=True)
+
+        while not stop.is_set():
+            changed, deleted, rescan = watcher.wait(CHECK_INTERVAL if settler.pending else 1.0)
+            if rescan:
+                # Events were lost -- go through the whole folders again, as on startup
+                logging.warning("Missed file events, rescanning folders")
+                changed, deleted = set(), set()
+                ingest(folders, outlook.load_known())
+
+            for path in deleted:
+                settler.discard(path)
+                if wanted(path):
+                    forget(sinks[0], path)
+            for path in changed:
+                if wanted(path):
+                    settler.add(path)
+
+            ready = settler.ready()
+            if ready:
+                emails, articles = totals.emails, totals.articles
+                start = time.perf_counter()
+                try:
+                    ingest(ready, outlook.load_known(ready))
+                except Exception:
+                    logging.exception("Could not parse new emails, trying them one at a time")
+                    outlook.db.rollback()
+                    for path in ready:
+                        try:
+                            ingest([path], outlook.load_known([path]))
+                        except Exception:
+                            logging.exception(f"Could not parse {path}, it will be retried when it changes")
+                            outlook.db.rollback()
+                if totals.emails > emails:
+                    logging.info("Parsed %d emails (%d articles) in %.2fs", totals.emails - emails,
+                                 totals.articles - articles, time.perf_counter() - start)
+
+            if rebuilder:
+                rebuilder.update(changed=bool(ready or deleted or rescan))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        logging.info("Stopping watch")
+        watcher.close()
+        if executor:
+            executor.shutdown()
+        if rebuilder:
+            rebuilder.close()
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+        outlook.finish(totals, sinks, log_setup, run_start, stats_path, prometheus_path)
+
+
+def watched_folders(folders):
+    # Emails land in new/ and cur/ of a Maildir, otherwise in the folder itself
+    watched = []
+    for folder in folders:
+        if is_maildir(folder):
+            watched += [os.path.join(folder, "new"), os.path.join(folder, "cur")]
+        else:
+            watched.append(folder)
+    return watched
+
+
+def wanted(path):
+    # Files the parser reads (see outlook.scan_folder), leaving out hidden files and Office lock files
+    name = os.path.basename(path)
+    if name.startswith((".", "~$")):
+        return False
+    if name.endswith((".msg", ".eml", ".mbox")) or is_archive(name):
+        return True
+    folder = os.path.dirname(path)
+    return os.path.basename(folder) in ("new", "cur") and is_maildir(os.path.dirname(folder))
+
+
+def forget(sink, path):
+    # Remove articles from a deleted email -- or from every email in a deleted mbox or archive
+    paths = outlook.load_known([path])
+    for known_path in paths:
+        logging.info(f"Removing articles from deleted email {os.path.basename(known_path)}")
+        sink.forget(known_path)
+    outlook.db.commit()
+
+
+class Settler:
+    # Holds changed files until their size and modified time stop changing for settle seconds
+    def __init__(self, settle):
+        self.settle = settle
+        self.pending = {}  # path -> (size, mtime, time they were last seen to change)
+
+    def add(self, path):
+        self.pending[path] = (None, None, time.monotonic())
+
+    def discard(self, path):
+        self.pending.pop(path, None)
+
+    def ready(self):
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.pending[path] = (stat.st_size, stat.st_mtime, now)
+            elif now - since >= self.settle:
+                ready.append(path)
+                del self.pending[path]
+        return ready
+
+
+def open_watcher(folders, poll_interval=1.0):
+    # inotify where available, otherwise polling
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folders)
+        except OSError as error:
+            logging.warning(f"inotify not available ({error}), polling every {poll_interval}s instead")
+    return PollingWatcher(folders, poll_interval)
+
+
+class InotifyWatcher:
+    # Linux inotify through libc, so no extra packages are needed
+    def __init__(self, folders):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.folders = {}  # watch descriptor -> folder
+        for folder in folders:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, f"Could not watch {folder}: {os.strerror(error)}")
+            self.folders[wd] = folder
+
+    def wait(self, timeout):
+        # Return (changed paths, deleted paths, rescan) for events within timeout seconds
+        changed = set()
+        deleted = set()
+        rescan = False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed, deleted, rescan
+
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+
+            position = 0
+            while position < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, position)
+                name = data[position + EVENT.size:position + EVENT.size + length].rstrip(b"\0")
+                position += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    logging.warning(f"Watched folder {self.folders.get(wd)} was removed or moved")
+                    continue
+                if mask & IN_ISDIR or wd not in self.folders or not name:
+                    continue
+
+                # Later events for the same file win, e.g. deleted and then copied in again
+                path = os.path.join(self.folders[wd], os.fsdecode(name))
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    deleted.add(path)
+                    changed.discard(path)
+                else:
+                    changed.add(path)
+                    deleted.discard(path)
+
+        return changed, deleted, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Compares the size and modified time of every file in the folders every interval seconds
+    def __init__(self, folders, interval=1.0):
+        self.folders = folders
+        self.interval = interval
+        self.files = self.scan()
+        self.last = time.monotonic()
+
+    def scan(self):
+        files = {}
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_size, stat.st_mtime)
+            except OSError as error:
+                logging.warning(f"Could not scan {folder}: {error}")
+        return files
+
+    def wait(self, timeout):
+        delay = self.last + self.interval - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set(), set(), False
+        time.sleep(max(delay, 0))
+
+        files = self.scan()
+        self.last = time.monotonic()
+        changed = {path for path, info in files.items() if self.files.get(path) != info}
+        deleted = self.files.keys() - files.keys()
+        self.files = files
+        return changed, deleted, False
+
+    def close(self):
+        pass
+
+
+class WorkbookRebuilder:
+    # Rebuilds the Excel report in a separate process at most every `every` seconds, when there are new articles
+    # The report is written to a temporary file and then moved into place, so a half-written report is never opened
+    def __init__(self, db_path, xlsx_path, every=60.0):
+        self.db_path = db_path
+        self.xlsx_path = xlsx_path
+        self.every = every
+        self.executor = self.start()
+        self.future = None
+        self.dirty = False
+        self.last = None
+
+    def start(self):
+        return ProcessPoolExecutor(max_workers=1, initializer=outlook.ignore_interrupts)
+
+    def update(self, changed=False):
+        self.dirty = self.dirty or changed
+        if self.future is not None and self.future.done():
+            self.collect()
+        if self.dirty and self.future is None and (self.last is None or time.monotonic() - self.last >= self.every):
+            import excel
+            try:
+                self.future = self.executor.submit(excel.export, self.db_path, self.temp_path())
+            except BrokenProcessPool:
+                # The report process was killed -- start a new one
+                logging.warning("Report process stopped, starting a new one")
+                self.executor = self.start()
+                self.future = self.executor.submit(excel.export, self.db_path, self.temp_path())
+            self.dirty = False
+            self.last = time.monotonic()
+
+    def temp_path(self):
+        root, extension = os.path.splitext(self.xlsx_path)
+        return f"{root}.tmp{extension}"
+
+    def collect(self):
+        future, self.future = self.future, None
+        self.replace(future.result)
+
+    def replace(self, rebuild):
+        # Wait for rebuild() to write the temporary report, then move it into place
+        try:
+            rows = rebuild()
+            os.replace(self.temp_path(), self.xlsx_path)
+            logging.info(f"Rebuilt {self.xlsx_path} ({rows} rows)")
+        except PermissionError:
+            # e.g. the report is open in Excel on Windows -- try again with the next rebuild
+            logging.warning(f"Could not replace {self.xlsx_path}, is it open? Trying again later")
+            self.dirty = True
+        except Exception:
+            logging.exception("Could not rebuild the Excel report")
+            self.dirty = True
+
+    def close(self):
+        # Finish the last rebuild, and do one more if articles came in since it started (or it failed)
+        # The last one is written in this process, so it doesn't depend on the report process still running
+        if self.future is not None:
+            self.collect()
+        self.executor.shutdown()
+        if self.dirty:
+            import excel
+            self.dirty = False
+            self.replace(lambda: excel.export(self.db_path, self.temp_path()))